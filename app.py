@@ -2,19 +2,67 @@ import streamlit as st
 if "run_count" not in st.session_state: st.session_state.run_count = 0
 st.session_state.run_count += 1
 print(f"\n--- EXECUÇÃO #{st.session_state.run_count} ---")
+import time
+_SCRIPT_T0 = time.perf_counter()
 import pandas as pd
-import json, base64, os, re, requests, io, sqlite3, glob
-import gspread
-from google.oauth2.service_account import Credentials
-from google import genai
-import yfinance as yf
+import json, base64, os, re, pathlib, requests, io, sqlite3, glob, sys, subprocess, importlib, threading, hashlib, unicodedata, math, itertools, contextlib
 import datetime
-import time
-import PIL.Image
 import numpy as np
-import plotly.express as px
-import plotly.io as pio
 import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed, Future
+from types import MappingProxyType
+from collections import namedtuple, defaultdict, Counter
+from tool_loop import LocalToolModel, run_tool_loop
+from sqlite_query import build_select, split_page
+
+# ===== Importação sob demanda =====
+# Integrações pesadas (Sheets, Gemini, yfinance, plotly, PIL) só são importadas
+# no primeiro acesso. Assim a página começa a ser desenhada antes delas.
+@st.cache_resource
+def get_lazy_import_times():
+    """Registro do processo com o tempo (s) gasto em cada import sob demanda"""
+    return {}
+
+class LazyModule:
+    """Proxy que adia o import de um módulo até o primeiro acesso a um atributo"""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            already_loaded = self._name in sys.modules
+            t0 = time.perf_counter()
+            self._module = importlib.import_module(self._name)
+            if not already_loaded:
+                get_lazy_import_times()[self._name] = time.perf_counter() - t0
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+class LazyObject:
+    """Proxy que só constrói o objeto (e importa o que ele precisa) no primeiro uso"""
+    def __init__(self, factory):
+        self._factory = factory
+        self._obj = None
+
+    def __getattr__(self, attr):
+        if self._obj is None:
+            self._obj = self._factory()
+        return getattr(self._obj, attr)
+
+gspread = LazyModule("gspread")
+service_account = LazyModule("google.oauth2.service_account")
+google_auth_requests = LazyModule("google.auth.transport.requests")
+genai = LazyModule("google.genai")
+yf = LazyModule("yfinance")
+px = LazyModule("plotly.express")
+pio = LazyModule("plotly.io")
+PIL_Image = LazyModule("PIL.Image")
+PIL_ImageOps = LazyModule("PIL.ImageOps")
+
+HEAVY_MODULES = ["gspread", "google.oauth2.service_account", "google.auth.transport.requests", "google.genai", "yfinance", "plotly.express", "plotly.io", "PIL.Image", "PIL.ImageOps"]
 
 # Suprimir avisos de depreciação do Kaleido para não poluir o log
 warnings.simplefilter("ignore", category=DeprecationWarning)
@@ -22,10 +70,147 @@ warnings.simplefilter("ignore", category=DeprecationWarning)
 # ===== Configuração da página =====
 st.set_page_config(page_title="PlasPrint IA", page_icon="favicon.ico", layout="wide")
 
+# Conexões SQLite do processo, emprestadas por consulta
+SQLITE_MMAP_SIZE = 64 * 2**20    # bytes do arquivo lidos via mmap
+SQLITE_CACHE_KB = 16000          # cache de páginas por conexão
+SQLITE_STATEMENT_CACHE = 256     # statements preparados guardados por conexão
+SQLITE_POOL_SIZE = 4             # conexões de leitura livres guardadas por arquivo
+SQLITE_IDLE_TTL = 60             # s parada antes de a conexão livre ser fechada
+SQLITE_REAP_INTERVAL = 1.0       # s entre as checagens da thread que fecha conexões
+
+class SQLitePool:
+    """Conexões de leitura compartilhadas pelo processo inteiro.
+
+    O Streamlit roda cada execução do script numa thread nova, então conexões por
+    thread nunca eram reaproveitadas. Aqui cada arquivo tem uma lista de conexões
+    livres: `with pool.reader(path) as conn` empresta uma (ou abre outra) e a
+    devolve ao sair, guardando no máximo SQLITE_POOL_SIZE. Elas abrem por URI
+    `mode=ro`, com mmap, cache de páginas maior e cache de statements preparados.
+
+    Cada empréstimo confere a identidade do arquivo (inode e `<banco>.version`,
+    gravado pelo sync_db.py). Se ela mudou, ou se existe `<banco>.swap` (troca
+    em andamento), as conexões livres são fechadas e as emprestadas são fechadas
+    na devolução, para o Windows conseguir substituir o arquivo. Uma thread faz a
+    mesma checagem a cada SQLITE_REAP_INTERVAL, mesmo sem consultas chegando, e
+    fecha as conexões paradas há mais de SQLITE_IDLE_TTL.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}        # caminho -> [(conexão, geração, devolvida_em)]
+        self._identity = {}    # caminho -> identidade vista no último empréstimo
+        self._generation = {}  # caminho -> geração atual; close_all avança
+        self.stats = {"aberturas": 0, "reusos": 0, "fechamentos": 0, "invalidacoes": 0}
+        threading.Thread(target=self._reaper, name="sqlite-pool-reaper", daemon=True).start()
+
+    @staticmethod
+    def _file_identity(path):
+        st_ = os.stat(path)
+        try:
+            version = os.stat(path + ".version").st_mtime_ns
+        except OSError:
+            version = None
+        return (st_.st_dev, st_.st_ino, version)
+
+    def close_all(self, path=None):
+        """Fecha as conexões livres (de um arquivo ou de todos); as emprestadas fecham ao voltar"""
+        with self._lock:
+            paths = [os.path.abspath(path)] if path else list(self._idle)
+            closing = []
+            for p in paths:
+                self._generation[p] = self._generation.get(p, 0) + 1
+                closing += [entry[0] for entry in self._idle.pop(p, [])]
+            self.stats["invalidacoes"] += 1
+            self.stats["fechamentos"] += len(closing)
+        for conn in closing:
+            conn.close()
+
+    def _open(self, path):
+        conn = sqlite3.connect(f"{pathlib.Path(path).absolute().as_uri()}?mode=ro", uri=True,
+                               cached_statements=SQLITE_STATEMENT_CACHE, check_same_thread=False)
+        conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+        return conn
+
+    @contextlib.contextmanager
+    def reader(self, path):
+        path = os.path.abspath(path)
+        identity = self._file_identity(path)
+        swapping = os.path.exists(path + ".swap")
+        if swapping or self._identity.get(path, identity) != identity:
+            self.close_all(path)
+        with self._lock:
+            self._identity[path] = identity
+            generation = self._generation.get(path, 0)
+            idle = self._idle.get(path, [])
+            while idle and idle[-1][1] != generation:
+                idle.pop()[0].close()
+            conn = idle.pop()[0] if idle else None
+            self.stats["reusos" if conn else "aberturas"] += 1
+        if conn is None:
+            conn = self._open(path)
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                idle = self._idle.setdefault(path, [])
+                keep = (not swapping and generation == self._generation.get(path, 0)
+                        and len(idle) < SQLITE_POOL_SIZE)
+                if keep:
+                    idle.append((conn, generation, time.monotonic()))
+                else:
+                    self.stats["fechamentos"] += 1
+            if not keep:
+                conn.close()
+
+    def _reaper(self):
+        # Sem isso, um app parado seguraria o arquivo aberto e o sync_db.py não conseguiria trocá-lo
+        while True:
+            time.sleep(SQLITE_REAP_INTERVAL)
+            for path in list(self._idle):
+                try:
+                    changed = (os.path.exists(path + ".swap")
+                               or self._file_identity(path) != self._identity.get(path))
+                except OSError:
+                    changed = True
+                if changed:
+                    self.close_all(path)
+                    continue
+                with self._lock:
+                    idle = self._idle.get(path, [])
+                    now = time.monotonic()
+                    stale = [e for e in idle if now - e[2] > SQLITE_IDLE_TTL]
+                    idle[:] = [e for e in idle if now - e[2] <= SQLITE_IDLE_TTL]
+                    self.stats["fechamentos"] += len(stale)
+                for entry in stale:
+                    entry[0].close()
+
+    def writer(self, path):
+        """Conexão de escrita avulsa (só o init_db grava); quem chama fecha.
+
+        Fica em journal de rollback, sem WAL: o arquivo é substituído inteiro pelo
+        sync_db.py e um -wal deixado ao lado seria aplicado sobre o banco novo. As
+        conexões de leitura do pool continuam abertas: enxergam o que for gravado.
+        """
+        conn = sqlite3.connect(path, cached_statements=SQLITE_STATEMENT_CACHE)
+        if conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+            # Arquivo de uma versão antiga: sair do WAL exige que só esta conexão o tenha aberto
+            self.close_all(path)
+            mode = conn.execute("PRAGMA journal_mode=DELETE").fetchone()[0]
+            if mode != "delete":
+                print(f"    ! {path} continua em journal_mode={mode} (outro processo com o arquivo aberto?)")
+        return conn
+
+@st.cache_resource(show_spinner=False)
+def get_sqlite_pool():
+    return SQLitePool()
+
+sqlite_pool = get_sqlite_pool()
+
 def init_db():
+    conn = None
     try:
         # Banco de Dados de Produção/Fichas (Sincronizado via BAT)
-        conn = sqlite3.connect('fichas_tecnicas.db')
+        conn = sqlite_pool.writer('fichas_tecnicas.db')
         cursor = conn.cursor()
         
         # Tabela de Fichas Técnicas
@@ -67,12 +252,67 @@ def init_db():
 
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_fichas_referencia ON fichas(referencia)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_fichas_produto ON fichas(produto)")
+
+        # Busca textual (FTS5) sobre referência, produto, decoração e observações. Tabela
+        # de conteúdo externo: o texto fica só em `fichas` e os gatilhos mantêm o índice
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS fichas_fts USING fts5(
+                referencia, produto, decoracao, obs,
+                content='fichas', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            )
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS fichas_fts_ai AFTER INSERT ON fichas BEGIN
+                INSERT INTO fichas_fts(rowid, referencia, produto, decoracao, obs)
+                VALUES (new.id, new.referencia, new.produto, new.decoracao, new.obs);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS fichas_fts_ad AFTER DELETE ON fichas BEGIN
+                INSERT INTO fichas_fts(fichas_fts, rowid, referencia, produto, decoracao, obs)
+                VALUES ('delete', old.id, old.referencia, old.produto, old.decoracao, old.obs);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS fichas_fts_au AFTER UPDATE ON fichas BEGIN
+                INSERT INTO fichas_fts(fichas_fts, rowid, referencia, produto, decoracao, obs)
+                VALUES ('delete', old.id, old.referencia, old.produto, old.decoracao, old.obs);
+                INSERT INTO fichas_fts(rowid, referencia, produto, decoracao, obs)
+                VALUES (new.id, new.referencia, new.produto, new.decoracao, new.obs);
+            END
+        ''')
+        # A cópia vinda da rede chega sem o índice: reconstrói quando as contagens divergem
+        indexed = cursor.execute("SELECT COUNT(*) FROM fichas_fts_docsize").fetchone()[0]
+        if indexed != cursor.execute("SELECT COUNT(*) FROM fichas").fetchone()[0]:
+            cursor.execute("INSERT INTO fichas_fts(fichas_fts) VALUES ('rebuild')")
         conn.commit()
-        conn.close()
     except Exception as e:
         st.error(f"Erro ao inicializar banco de dados: {e}")
+    finally:
+        if conn is not None:
+            conn.close()
 
-init_db()
+def db_version(path):
+    """Muda quando o arquivo é gravado ou trocado (inclusive pelo sync_db.py, via `.version`);
+    entra nas chaves de cache das consultas"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    try:
+        synced = os.stat(path + ".version").st_mtime_ns
+    except OSError:
+        synced = None
+    return (stat.st_mtime_ns, stat.st_size, synced)
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def init_db_once(version):
+    """init_db uma vez por processo e por versão do arquivo, e não a cada rerun"""
+    init_db()
+    return version
+
+init_db_once(db_version('fichas_tecnicas.db'))
 
 
 def get_usd_brl_rate():
@@ -668,42 +908,858 @@ except:
     st.error("Configure os segredos GEMINI_API_KEY, SHEET_ID e SERVICE_ACCOUNT_B64.")
     st.stop()
 
-sa_json = json.loads(base64.b64decode(SERVICE_ACCOUNT_B64).decode())
-scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
-creds = Credentials.from_service_account_info(sa_json, scopes=scopes)
-gc = gspread.authorize(creds)
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files/{}"
+# Intervalo mínimo (s) entre consultas de revisão da planilha no Drive
+REVISION_CHECK_INTERVAL = float(st.secrets.get("REVISION_CHECK_INTERVAL", 60))
+# Frequência (s) com que cada sessão verifica se chegaram dados novos (só memória, sem rede)
+DATA_WATCH_INTERVAL = min(REVISION_CHECK_INTERVAL, 10)
+
+# Cota de leitura do Sheets por usuário é ~60/min; a conta de serviço é um único usuário
+GOOGLE_API_RATE = float(st.secrets.get("GOOGLE_API_RATE", 1.0))  # chamadas/s em regime
+GOOGLE_API_BURST = int(st.secrets.get("GOOGLE_API_BURST", 10))
+
+def is_rate_limit_error(e):
+    """429 pelo código HTTP (gspread/requests: e.response; google-genai: e.code/e.status), nunca pelo texto"""
+    response = getattr(e, "response", None)
+    return (getattr(response, "status_code", None) == 429 or getattr(e, "code", None) == 429
+            or getattr(e, "status", None) == "RESOURCE_EXHAUSTED")
+
+def retry_after_seconds(e):
+    """Lê o cabeçalho Retry-After da resposta, se o servidor mandou um"""
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+class GoogleRateLimiter:
+    """Token bucket do processo para todas as chamadas às APIs do Google (Sheets e Drive).
+
+    Chamadas idênticas em andamento (mesma `key`) são coalescidas: só a primeira vai
+    à rede e as demais recebem o mesmo resultado. Um 429 corta a taxa pela metade e
+    espera (Retry-After ou backoff exponencial); sucessos recuperam a taxa aos poucos.
+    """
+    def __init__(self, rate, burst, max_retries=4):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._inflight = {}  # chave -> Future
+        self.stats = {"chamadas": 0, "coalescidas": 0, "espera_total_s": 0.0, "erros_429": 0, "retentativas": 0}
+
+    def _acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.stats["chamadas"] += 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+                self.stats["espera_total_s"] = round(self.stats["espera_total_s"] + wait, 2)
+            time.sleep(wait)
+
+    def _on_success(self):
+        with self._lock:
+            self.rate = min(self.base_rate, self.rate * 1.1)
+
+    def _on_rate_limited(self):
+        with self._lock:
+            self.rate = max(self.base_rate / 16, self.rate / 2)
+            self.stats["erros_429"] += 1
+
+    def _call_with_backoff(self, fn, args, kwargs):
+        delay = 2.0
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+                self._on_rate_limited()
+                self.stats["retentativas"] += 1
+                time.sleep(retry_after_seconds(e) or delay)
+                delay *= 2
+                continue
+            self._on_success()
+            return result
+
+    def call(self, fn, *args, key=None, **kwargs):
+        if key is None:
+            return self._call_with_backoff(fn, args, kwargs)
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+            else:
+                self.stats["coalescidas"] += 1
+        if not owner:
+            return future.result()
+        try:
+            result = self._call_with_backoff(fn, args, kwargs)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+@st.cache_resource(show_spinner=False)
+def get_google_limiter(rate, burst):
+    return GoogleRateLimiter(rate, burst)
+
+google_limiter = get_google_limiter(GOOGLE_API_RATE, GOOGLE_API_BURST)
+
+class GoogleClients:
+    """Credenciais, cliente gspread e planilha compartilhados por todas as sessões do processo"""
+    SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+    REFRESH_MARGIN = 300  # renova o token 5 min antes de expirar
+
+    def __init__(self, service_account_b64, sheet_id):
+        sa_json = json.loads(base64.b64decode(service_account_b64).decode())
+        self.creds = service_account.Credentials.from_service_account_info(sa_json, scopes=self.SCOPES)
+        self.sheet_id = sheet_id
+        self._lock = threading.Lock()
+        # gspread só é importado quando a planilha for lida de fato (a revisão usa só o Drive)
+        self._gc = None
+        self._sh = None
+        self.session = google_auth_requests.AuthorizedSession(self.creds)
+        threading.Thread(target=self._token_refresher, name="google-token-refresh", daemon=True).start()
+
+    @property
+    def gc(self):
+        with self._lock:
+            if self._gc is None:
+                self._gc = gspread.authorize(self.creds)
+            return self._gc
+
+    def spreadsheet(self):
+        if self._sh is None:
+            sh = google_limiter.call(self.gc.open_by_key, self.sheet_id, key=f"open:{self.sheet_id}")
+            with self._lock:
+                self._sh = self._sh or sh
+        return self._sh
+
+    def reopen(self):
+        """Reabre a planilha; se a rede falhar, continua com o handle em cache"""
+        if self._sh is None:
+            return self.spreadsheet()
+        try:
+            sh = google_limiter.call(self.gc.open_by_key, self.sheet_id, key=f"open:{self.sheet_id}")
+            with self._lock:
+                self._sh = sh
+        except Exception as e:
+            print(f"    ! Falha ao reabrir a planilha, usando handle em cache: {e}")
+        return self._sh
+
+    def drive_revision(self):
+        """Revisão atual da planilha no Drive: uma chamada leve, apenas metadados"""
+        def fetch():
+            # raise_for_status dentro da chamada limitada: um 429 do Drive passa pelo backoff
+            res = self.session.get(DRIVE_FILES_URL.format(self.sheet_id),
+                                   params={"fields": "version,modifiedTime", "supportsAllDrives": "true"}, timeout=10)
+            res.raise_for_status()
+            return res.json()
+        meta = google_limiter.call(fetch, key=f"revision:{self.sheet_id}")
+        return f"{meta.get('version')}@{meta.get('modifiedTime')}"
+
+    def _seconds_to_expiry(self):
+        expiry = self.creds.expiry
+        if expiry is None:
+            return 0
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return (expiry - now).total_seconds()
+
+    def _token_refresher(self):
+        # Renova o token em segundo plano para que nenhuma requisição de usuário pague o refresh
+        while True:
+            try:
+                if not self.creds.valid or self._seconds_to_expiry() < self.REFRESH_MARGIN:
+                    with self._lock:
+                        self.creds.refresh(google_auth_requests.Request())
+                wait = max(self._seconds_to_expiry() - self.REFRESH_MARGIN, 30)
+            except Exception as e:
+                print(f"    ! Falha ao renovar token do Google: {e}")
+                wait = 60
+            time.sleep(wait)
+
+@st.cache_resource(show_spinner=False)
+def get_google_clients(service_account_b64, sheet_id):
+    return GoogleClients(service_account_b64, sheet_id)
+
+@st.cache_resource(show_spinner=False)
+def get_genai_client(api_key):
+    return genai.Client(api_key=api_key)
+
+SHEET_TABS = ["erros", "dacen", "psi", "gerais"]
+SHEET_FETCH_WORKERS = 4
+# Após N sincronizações incrementais seguidas, uma recarga completa pega edições no meio da aba
+FULL_SYNC_EVERY = int(st.secrets.get("FULL_SYNC_EVERY", 20))
+SNAPSHOT_DB = "snapshots.db"
+GOOGLE_RETRY_INTERVAL = 60  # s entre tentativas de reconectar quando o Google está fora
+
+class SnapshotStore:
+    """Cópia local (SQLite, ao lado do fichas_tecnicas.db) de cada aba carregada.
+
+    Cada aba vira a tabela `aba_<nome>`; `snapshot_meta` guarda a revisão e o horário
+    da carga. Novas sessões partem daqui, e o assistente continua funcionando com a
+    última cópia quando a API do Sheets está lenta ou fora do ar.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._staged = {}  # aba -> metadados que só são gravados junto com os dados
+        conn = sqlite3.connect(self.path)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS snapshot_meta (
+                aba TEXT PRIMARY KEY,
+                revision TEXT,
+                loaded_at TEXT,
+                linhas INTEGER
+            )
+        ''')
+        try:
+            # Estado da sincronização incremental (adicionado depois da primeira versão)
+            conn.execute("ALTER TABLE snapshot_meta ADD COLUMN sync_state TEXT")
+        except sqlite3.OperationalError:
+            pass
+        conn.commit()
+        conn.close()
+
+    def apply_change_set(self, cs, df):
+        """Consumidor do DataRegistry: só linhas novas são anexadas; o resto reescreve a aba.
+
+        Os metadados preparados com stage_meta entram na mesma transação; se a escrita
+        falhar, a cópia local continua descrevendo os dados antigos.
+        """
+        with self._lock:
+            meta = self._staged.pop(cs.table, None)
+        if cs.table not in SHEET_TABS or len(df.columns) == 0:
+            # fichas e produtos já vêm do banco local; só as abas do Sheets têm cópia aqui
+            return
+        table = f"aba_{cs.table}"
+        with self._lock:
+            conn = sqlite3.connect(self.path)
+            try:
+                if cs.full or cs.removed or cs.modified:
+                    df.to_sql(table, conn, if_exists="replace", index=False)
+                elif cs.added:
+                    df.iloc[cs.added].to_sql(table, conn, if_exists="append", index=False)
+                if meta is not None:
+                    self._write_meta(conn, cs.table, *meta)
+                conn.commit()
+            finally:
+                conn.close()
 
-try:
-    sh = gc.open_by_key(SHEET_ID)
-except Exception as e:
-    st.error(f"Não consegui abrir a planilha: {e}")
-    st.stop()
+    def stage_meta(self, name, revision, loaded_at, sync, linhas):
+        """Prepara os metadados da aba para serem gravados pelo próximo ChangeSet"""
+        with self._lock:
+            self._staged[name] = (revision, loaded_at, sync, linhas)
+
+    def save_staged(self):
+        """Grava os metadados que nenhum ChangeSet levou (conteúdo igual ao da cópia)"""
+        with self._lock:
+            staged, self._staged = self._staged, {}
+        for name, meta in staged.items():
+            self.save_meta(name, *meta)
+
+    def save_meta(self, name, revision, loaded_at, sync, linhas):
+        """Atualiza só os metadados (revisão sem linhas novas não reescreve a aba)"""
+        with self._lock:
+            conn = sqlite3.connect(self.path)
+            try:
+                self._write_meta(conn, name, revision, loaded_at, sync, linhas)
+                conn.commit()
+            finally:
+                conn.close()
 
-@st.cache_data
-def read_ws(name):
+    def _write_meta(self, conn, name, revision, loaded_at, sync, linhas):
+        conn.execute("INSERT OR REPLACE INTO snapshot_meta (aba, revision, loaded_at, linhas, sync_state) VALUES (?, ?, ?, ?, ?)",
+                     (name, revision, loaded_at.isoformat(), linhas, json.dumps(sync) if sync else None))
+
+    def load(self, name):
+        """Retorna {"df", "revision", "loaded_at", "sync"} ou None se não houver cópia da aba"""
+        conn = sqlite3.connect(self.path)
+        try:
+            meta = conn.execute("SELECT revision, loaded_at, sync_state FROM snapshot_meta WHERE aba = ?", (name,)).fetchone()
+            if meta is None:
+                return None
+            df = pd.read_sql_query(f'SELECT * FROM "aba_{name}"', conn)
+            return {"df": df, "revision": meta[0], "loaded_at": datetime.datetime.fromisoformat(meta[1]),
+                    "sync": json.loads(meta[2]) if meta[2] else None}
+        except Exception as e:
+            print(f"    ! Cópia local da aba '{name}' ilegível: {e}")
+            return None
+        finally:
+            conn.close()
+
+@st.cache_resource(show_spinner=False)
+def get_snapshot_store(path):
+    return SnapshotStore(path)
+
+@st.cache_resource(show_spinner=False)
+def get_google_connection_state():
+    return {"failed_at": None, "error": None}
+
+def connect_google(open_sheet=False):
+    """Clientes Google do processo, ou None enquanto a planilha estiver inacessível.
+
+    Com open_sheet a planilha é aberta já (sem cópia local não há o que mostrar);
+    senão fica para a primeira leitura, em segundo plano.
+    """
+    state = get_google_connection_state()
+    if state["failed_at"] is not None and time.monotonic() - state["failed_at"] < GOOGLE_RETRY_INTERVAL:
+        return None
     try:
-        ws = sh.worksheet(name)
-        return pd.DataFrame(ws.get_all_records())
+        clients = get_google_clients(SERVICE_ACCOUNT_B64, SHEET_ID)
+        if open_sheet:
+            clients.spreadsheet()
+        state["failed_at"], state["error"] = None, None
+        return clients
     except Exception as e:
-        st.warning(f"Aba '{name}' não pôde ser carregada: {e}")
-        return pd.DataFrame()
+        state["failed_at"], state["error"] = time.monotonic(), e
+        print(f"    ! Não consegui abrir a planilha: {e}")
+        return None
 
-@st.cache_data
-def read_sqlite(table_name):
-    try:
-        conn = sqlite3.connect('fichas_tecnicas.db')
-        df = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
-        conn.close()
+# ===== Esquema tipado das tabelas =====
+# Texto repetitivo vira categórico e números são reduzidos ao menor tipo exato,
+# o que barateia filtros, build_context e cada cópia em cache.
+CATEGORY_COLUMNS = {"maquina", "produto", "decoracao", "turno", "operador", "setor", "cor", "status"}
+CATEGORY_MAX_RATIO = 0.5  # demais colunas de texto viram categóricas se até 50% dos valores forem distintos
+FICHAS_PARAM_COLUMNS = ["tempo_s", "cyan", "magenta", "yellow", "black", "white", "varnish",
+                        "largura", "altura", "diametro", "print_edge", "powergrade", "finish_time",
+                        "intervalo", "uv_lamp"]
+TABLE_SCHEMAS = {
+    "fichas": {"category": ["produto"], "float32": FICHAS_PARAM_COLUMNS},
+    "produtos": {"float32": ["tempo_padrao"]},
+}
+
+def normalize_text(text):
+    """Minúsculas e sem acentos, para comparar nomes de colunas e buscar texto"""
+    text = unicodedata.normalize("NFKD", str(text))
+    return "".join(c for c in text if not unicodedata.combining(c)).lower().strip()
+
+@st.cache_resource(show_spinner=False)
+def get_schema_reports():
+    """Memória antes/depois da tipagem, por tabela (último carregamento)"""
+    return {}
+
+def smallest_int_dtype(s):
+    lo, hi = s.min(), s.max()
+    for dtype in ("Int8", "Int16", "Int32"):
+        info = np.iinfo(dtype.lower())
+        if info.min <= lo and hi <= info.max:
+            return dtype
+    return "Int64"
+
+def compact_column(s):
+    """Tipo compacto para uma coluna sem esquema declarado (object/str vinda do Sheets ou SQLite)"""
+    blank = s.isna() | (s.astype(str).str.strip() == "")
+    filled = s[~blank]
+    if filled.empty:
+        return s
+    if all(isinstance(v, (int, float, np.number)) and not isinstance(v, bool) for v in filled):
+        num = pd.to_numeric(s.where(~blank), errors="coerce")
+        valid = num.dropna()
+        if (valid == valid.round()).all():
+            return num.astype(smallest_int_dtype(valid))
+        return num
+    if all(isinstance(v, str) for v in filled) and filled.nunique() <= CATEGORY_MAX_RATIO * len(filled):
+        return s.astype("category")
+    return s
+
+def apply_schema(name, df):
+    """Aplica TABLE_SCHEMAS (ou as regras gerais) e registra o uso de memória antes/depois"""
+    if len(df.columns) == 0:
         return df
+    before = float(df.memory_usage(deep=True).sum())
+    schema = TABLE_SCHEMAS.get(name, {})
+    typed = {}
+    for col in df.columns:
+        s = df[col]
+        if col in schema.get("float32", []):
+            s = pd.to_numeric(s, errors="coerce").astype("float32")
+        elif col in schema.get("category", []) or normalize_text(col) in CATEGORY_COLUMNS:
+            s = s.astype("category")
+        elif pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s):
+            s = compact_column(s)
+        elif pd.api.types.is_float_dtype(s):
+            # Inteiros com vazios voltam do SQLite como float64: mesmo tipo da carga pelo Sheets
+            valid = s.dropna()
+            if not valid.empty and (valid == valid.round()).all():
+                s = s.astype(smallest_int_dtype(valid))
+        elif pd.api.types.is_integer_dtype(s):
+            s = pd.to_numeric(s, downcast="integer")
+        typed[col] = s
+    typed = pd.DataFrame(typed, index=df.index)
+    after = float(typed.memory_usage(deep=True).sum())
+    get_schema_reports()[name] = {"linhas": len(typed), "antes_kb": round(before / 1024, 1),
+                                  "depois_kb": round(after / 1024, 1),
+                                  "reducao_%": round(100 * (1 - after / before), 1) if before else 0.0}
+    return typed
+
+def widen_for_display(df):
+    """Colunas float32 voltam a float64 com a representação curta (0.057, e não 0.0570000000298)"""
+    f32 = [c for c in df.columns if df[c].dtype == np.float32]
+    if not f32:
+        return df
+    out = df.copy(deep=False)
+    for c in f32:
+        out[c] = [float(str(v)) for v in df[c].to_numpy()]
+    return out
+
+def row_hash(row):
+    # O Sheets omite as células vazias do fim da linha; normaliza antes de comparar
+    row = [str(v) for v in row]
+    while row and row[-1] == "":
+        row.pop()
+    return hashlib.sha1(json.dumps(row, ensure_ascii=False).encode()).hexdigest()
+
+def sync_state_from_values(values):
+    """Marcadores da sincronização incremental: nº de linhas, hash do cabeçalho e da última linha"""
+    if not values:
+        return None
+    return {"rows": len(values), "width": len(values[0]), "header_hash": row_hash(values[0]),
+            "tail_hash": row_hash(values[-1]), "incrementais": 0}
+
+def values_to_dataframe(values):
+    """Converte a matriz crua do Sheets em DataFrame, com o mesmo resultado de get_all_records()"""
+    if not values:
+        return pd.DataFrame()
+    headers = [str(h) for h in values[0]]
+    width = len(headers)
+    records = []
+    for row in values[1:]:
+        row = list(row[:width]) + [""] * (width - len(row))
+        records.append(dict(zip(headers, gspread.utils.numericise_all(row))))
+    return pd.DataFrame(records, columns=headers)
+
+def fetch_ws_values(spreadsheet, name):
+    """Busca uma aba isolada (caminho de contingência quando o lote falha)"""
+    t0 = time.perf_counter()
+    values = google_limiter.call(lambda: spreadsheet.worksheet(name).get_all_values(), key=f"ws:{name}")
+    return values, time.perf_counter() - t0
+
+def fetch_worksheets(spreadsheet, names):
+    """Busca várias abas com uma única chamada values_batch_get e converte em paralelo.
+
+    Se o lote falhar (ex.: uma aba renomeada), cada aba é buscada em um pool limitado
+    de threads, isolando o erro. Retorna (dfs, timings, errors); nenhuma chamada ao
+    Streamlit é feita fora da thread principal.
+    """
+    names = list(names)
+    raw, timings, errors = {}, {name: {} for name in names}, {}
+    t0 = time.perf_counter()
+    try:
+        ranges = [gspread.utils.absolute_range_name(n) for n in names]
+        resp = google_limiter.call(spreadsheet.values_batch_get, ranges, key=f"batch:{ranges}")
+        elapsed = time.perf_counter() - t0
+        for name, value_range in zip(names, resp.get("valueRanges", [])):
+            raw[name] = value_range.get("values", [])
+            timings[name]["rede_ms"] = round(elapsed * 1000)
+    except Exception as batch_error:
+        print(f"    ! Leitura em lote falhou ({batch_error}); buscando abas em paralelo")
+        with ThreadPoolExecutor(max_workers=min(SHEET_FETCH_WORKERS, len(names))) as pool:
+            futures = {pool.submit(fetch_ws_values, spreadsheet, n): n for n in names}
+            for fut in as_completed(futures):
+                name = futures[fut]
+                try:
+                    raw[name], elapsed = fut.result()
+                    timings[name]["rede_ms"] = round(elapsed * 1000)
+                except Exception as e:
+                    errors[name] = e
+
+    def convert(name):
+        t = time.perf_counter()
+        df = apply_schema(name, values_to_dataframe(raw[name]))
+        return name, df, time.perf_counter() - t
+
+    dfs = {name: pd.DataFrame() for name in names}
+    states = {name: sync_state_from_values(values) for name, values in raw.items()}
+    with ThreadPoolExecutor(max_workers=min(SHEET_FETCH_WORKERS, max(len(raw), 1))) as pool:
+        for name, df, elapsed in pool.map(convert, list(raw)):
+            dfs[name] = df
+            timings[name]["conversao_ms"] = round(elapsed * 1000)
+            timings[name]["linhas"] = len(df)
+    return dfs, timings, errors, states
+
+def fetch_appended(spreadsheet, states):
+    """Busca, em uma única chamada, só as linhas novas de cada aba (abas append-only).
+
+    Relê o cabeçalho e a última linha conhecida de cada aba junto com o intervalo
+    A{n}:Z seguinte. Se o cabeçalho ou a última linha mudaram (edição, exclusão,
+    aba encolheu), a aba vai para a recarga completa. Retorna
+    ({aba: (cabeçalho, linhas_novas, novo_estado)}, [abas_para_recarga_completa]).
+    """
+    names = list(states)
+    ranges = []
+    for name in names:
+        state = states[name]
+        last_col = re.sub(r"\d", "", gspread.utils.rowcol_to_a1(1, max(state["width"], 26)))
+        ranges.append(gspread.utils.absolute_range_name(name, f"A1:{last_col}1"))
+        ranges.append(gspread.utils.absolute_range_name(name, f"A{state['rows']}:{last_col}"))
+    value_ranges = google_limiter.call(spreadsheet.values_batch_get, ranges, key=f"batch:{ranges}").get("valueRanges", [])
+
+    appended, full = {}, []
+    for i, name in enumerate(names):
+        state = states[name]
+        header = (value_ranges[2 * i].get("values") or [[]])[0]
+        tail = value_ranges[2 * i + 1].get("values", [])
+        if row_hash(header) != state["header_hash"] or not tail or row_hash(tail[0]) != state["tail_hash"]:
+            full.append(name)
+            continue
+        new_rows = tail[1:]
+        appended[name] = (header, new_rows, {**state, "rows": state["rows"] + len(new_rows),
+                                             "tail_hash": row_hash(tail[-1]),
+                                             "incrementais": state["incrementais"] + 1})
+    return appended, full
+
+# Conjunto de mudanças de uma tabela entre duas versões (posições de linha, comparação posicional)
+ChangeSet = namedtuple("ChangeSet", "table old_version new_version added removed modified full")
+CHANGESET_FULL_RATIO = 0.5  # acima disso, consumidores devem reconstruir em vez de aplicar o delta
+
+def table_row_hashes(df):
+    """Hash do conteúdo de cada linha (independe do índice, do tipo categórico e da forma do vazio)"""
+    if len(df.columns) == 0:
+        return np.array([], dtype="uint64")
+    values = widen_for_display(df).astype(object)
+    values = values.where(values.notna(), "")
+    return pd.util.hash_pandas_object(values.astype(str), index=False).to_numpy()
+
+def diff_row_hashes(table, old, new):
+    """Compara duas versões linha a linha; as abas crescem no fim, então a posição é a chave"""
+    old_hashes, new_hashes = old["hashes"] if old else np.array([], dtype="uint64"), new["hashes"]
+    common = min(len(old_hashes), len(new_hashes))
+    modified = np.flatnonzero(old_hashes[:common] != new_hashes[:common]).tolist()
+    added = list(range(common, len(new_hashes)))
+    removed = list(range(common, len(old_hashes)))
+    full = (old is None or old["columns"] != new["columns"]
+            or len(modified) + len(removed) > CHANGESET_FULL_RATIO * max(len(old_hashes), 1))
+    return ChangeSet(table, old["version"] if old else None, new["version"], added, removed, modified, full)
+
+class DataRegistry:
+    """Versão atual das tabelas carregadas, somente leitura e compartilhada pelo processo.
+
+    Uma recarga publica uma nova versão (copy-on-refresh: só as abas alteradas são
+    trocadas, as demais seguem pela mesma referência) e a anterior é descartada.
+    As sessões guardam apenas o número da versão, então a memória não cresce com o
+    número de abas abertas no navegador.
+
+    Cada tabela carrega hashes por linha e uma versão de conteúdo. Publicar emite um
+    ChangeSet (linhas adicionadas, removidas, modificadas) para os consumidores
+    inscritos, que se atualizam de forma incremental; uma tabela republicada sem
+    mudança de conteúdo é ignorada.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = 0
+        self._tables = MappingProxyType({})
+        self._meta = {}  # tabela -> {"version", "hashes", "columns"}
+        self._subscribers = {}
+        self.last_changes = {}
+
+    def subscribe(self, key, callback):
+        """Registra callback(change_set, df); a chave evita inscrições duplicadas entre reruns"""
+        self._subscribers[key] = callback
+
+    def table_version(self, name):
+        meta = self._meta.get(name)
+        return meta["version"] if meta else None
+
+    def publish(self, changed):
+        change_sets = []
+        with self._lock:
+            tables = dict(self._tables)
+            for name, df in changed.items():
+                hashes = table_row_hashes(df)
+                meta = {"version": hashlib.sha1(hashes.tobytes()).hexdigest()[:12], "hashes": hashes,
+                        "columns": list(df.columns)}
+                old = self._meta.get(name)
+                if old is not None and old["version"] == meta["version"] and old["columns"] == meta["columns"]:
+                    continue
+                change_sets.append((diff_row_hashes(name, old, meta), df))
+                self._meta[name] = meta
+                tables[name] = df
+            if change_sets:
+                self._tables = MappingProxyType(tables)
+                self.version += 1
+        for cs, df in change_sets:
+            self.last_changes[cs.table] = {"versao": cs.new_version, "adicionadas": len(cs.added),
+                                           "removidas": len(cs.removed), "modificadas": len(cs.modified),
+                                           "completa": cs.full}
+            for key, callback in list(self._subscribers.items()):
+                try:
+                    callback(cs, df)
+                except Exception as e:
+                    print(f"    ! Consumidor '{key}' falhou ao aplicar mudanças de '{cs.table}': {e}")
+        return self.version
+
+    def current(self):
+        """(versão, tabelas) lidos de forma consistente; os DataFrames não devem ser alterados"""
+        with self._lock:
+            return self.version, self._tables
+
+@st.cache_resource(show_spinner=False)
+def get_data_registry():
+    return DataRegistry()
+
+class SheetCache:
+    """Cache das abas compartilhado pelo processo, invalidado pela revisão do Drive.
+
+    A revisão é consultada no máximo uma vez a cada `check_interval` segundos. Cada aba
+    guarda a revisão em que foi lida e só é buscada de novo quando ela muda, então
+    recargas sem alteração na planilha não consomem cota do Sheets. O cache começa
+    preenchido pela cópia local (SnapshotStore) e cada troca de dados é publicada no
+    DataRegistry.
+    """
+    def __init__(self, snapshots, registry, check_interval):
+        self.clients = None
+        self.snapshots = snapshots
+        self.registry = registry
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._entries = {}  # aba -> {"df", "revision", "loaded_at", "sync"}
+        self._revision = None
+        self._checked_at = 0.0
+        self._refreshing = False
+        self.stats = {"checagens": 0, "abas_recarregadas": 0, "abas_sem_mudanca": 0, "abas_da_copia_local": 0,
+                      "sincronizacoes_incrementais": 0, "linhas_incrementais": 0, "recargas_completas": 0}
+        for name in SHEET_TABS:
+            snap = snapshots.load(name)
+            if snap is not None:
+                snap["df"] = apply_schema(name, snap["df"])
+                self._entries[name] = snap
+                self.stats["abas_da_copia_local"] += 1
+        if self._entries:
+            registry.publish({n: e["df"] for n, e in self._entries.items()})
+
+    def attach(self, clients):
+        self.clients = clients
+
+    def has(self, names):
+        return all(n in self._entries for n in names)
+
+    def loaded_at(self, name):
+        entry = self._entries.get(name)
+        return entry["loaded_at"] if entry else None
+
+    def _check_due(self):
+        return self._revision is None or time.monotonic() - self._checked_at >= self.check_interval
+
+    def current_revision(self, force=False):
+        if self.clients is not None and (force or self._check_due()):
+            self._checked_at = time.monotonic()
+            self.stats["checagens"] += 1
+            try:
+                self._revision = self.clients.drive_revision()
+            except Exception as e:
+                # Sem o Drive, mantém a última revisão conhecida e segue com o cache
+                print(f"    ! Não foi possível consultar a revisão da planilha: {e}")
+        return self._revision
+
+    def get(self, names, force=False):
+        """Retorna (dfs, timings, errors), buscando só as abas desatualizadas"""
+        names = list(names)
+        with self._lock:
+            revision = self.current_revision(force)
+            stale = [n for n in names if n not in self._entries
+                     or (self.clients is not None and revision is not None
+                         and self._entries[n]["revision"] != revision)]
+            timings, errors = {}, {}
+            if stale and self.clients is None:
+                errors = {n: RuntimeError("planilha inacessível; usando a cópia local") for n in stale}
+            elif stale:
+                updated, timings, errors = self._fetch(stale)
+                previous = {n: self._entries[n]["df"] for n in stale if n in self._entries}
+                now = datetime.datetime.now()
+                for name, (df, sync) in updated.items():
+                    self._entries[name] = {"df": df, "revision": revision, "loaded_at": now, "sync": sync}
+                changed = {n: df for n, (df, _) in updated.items() if previous.get(n) is not df}
+                try:
+                    for name, (df, sync) in updated.items():
+                        if name in changed:
+                            # Vão junto com os dados do ChangeSet, só se a escrita der certo
+                            self.snapshots.stage_meta(name, revision, now, sync, len(df))
+                        else:
+                            self.snapshots.save_meta(name, revision, now, sync, len(df))
+                    if changed:
+                        self.registry.publish(changed)
+                    self.snapshots.save_staged()
+                except Exception as e:
+                    print(f"    ! Falha ao gravar cópia local das abas {sorted(updated)}: {e}")
+                self.stats["abas_recarregadas"] += len(changed)
+            self.stats["abas_sem_mudanca"] += len(names) - len(stale)
+            for name in names:
+                if name not in timings and name in self._entries:
+                    timings[name] = {"origem": "cache", "linhas": len(self._entries[name]["df"])}
+            result = {n: self._entries[n]["df"] if n in self._entries else pd.DataFrame() for n in names}
+        return result, timings, errors
+
+    def _fetch(self, stale):
+        """Sincroniza as abas desatualizadas: incremental quando possível, completa quando não.
+
+        Retorna ({aba: (df, sync)}, timings, errors). Uma aba sem linhas novas devolve o
+        mesmo objeto DataFrame, o que evita publicar uma versão nova sem mudança.
+        """
+        try:
+            spreadsheet = self.clients.spreadsheet()
+        except Exception as e:
+            # A planilha é aberta na primeira leitura; se falhar, as abas seguem da cópia local
+            return {}, {}, {name: e for name in stale}
+        updated, timings, errors = {}, {}, {}
+        incremental = {n: self._entries[n]["sync"] for n in stale
+                       if n in self._entries and self._entries[n].get("sync")
+                       and self._entries[n]["sync"]["incrementais"] < FULL_SYNC_EVERY}
+        full = [n for n in stale if n not in incremental]
+        if incremental:
+            t0 = time.perf_counter()
+            try:
+                appended, fallback = fetch_appended(spreadsheet, incremental)
+            except Exception as e:
+                print(f"    ! Sincronização incremental falhou ({e}); recarregando as abas inteiras")
+                appended, fallback = {}, list(incremental)
+            elapsed_ms = round((time.perf_counter() - t0) * 1000)
+            full += fallback
+            for name, (header, rows, sync) in appended.items():
+                df = self._entries[name]["df"]
+                if rows:
+                    df = apply_schema(name, pd.concat([df, values_to_dataframe([header] + rows)], ignore_index=True))
+                updated[name] = (df, sync)
+                timings[name] = {"origem": "incremental", "rede_ms": elapsed_ms, "linhas_novas": len(rows), "linhas": len(df)}
+                self.stats["linhas_incrementais"] += len(rows)
+            self.stats["sincronizacoes_incrementais"] += len(appended)
+        if full:
+            dfs, full_timings, errors, states = fetch_worksheets(spreadsheet, full)
+            if errors:
+                # O handle em cache pode ter ficado velho: reabre a planilha e tenta as abas com
+                # erro mais uma vez. Se reabrir falhar, reopen devolve o mesmo handle e elas
+                # seguem com a versão anterior
+                reopened = self.clients.reopen()
+                if reopened is not spreadsheet:
+                    retry_dfs, retry_timings, errors, retry_states = fetch_worksheets(reopened, list(errors))
+                    dfs.update(retry_dfs)
+                    full_timings.update(retry_timings)
+                    states.update(retry_states)
+            timings.update(full_timings)
+            for name in full:
+                if name not in errors:  # em caso de erro mantém a versão anterior da aba
+                    updated[name] = (dfs[name], states.get(name))
+            self.stats["recargas_completas"] += len(full) - len(errors)
+        return updated, timings, errors
+
+    def refresh_async(self, names):
+        """Dispara a checagem/recarga em segundo plano, se estiver na hora e ninguém já estiver fazendo"""
+        if self.clients is None or self._refreshing or not self._check_due():
+            return
+        self._refreshing = True
+
+        def run():
+            try:
+                self.get(names)
+            except Exception as e:
+                print(f"    ! Atualização em segundo plano falhou: {e}")
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name="sheet-refresh", daemon=True).start()
+
+@st.cache_resource(show_spinner=False)
+def get_sheet_cache(check_interval):
+    snapshots, registry = get_snapshot_store(SNAPSHOT_DB), get_data_registry()
+    cache = SheetCache(snapshots, registry, check_interval)
+    # Inscrito só depois de semear o cache com a própria cópia local
+    registry.subscribe("snapshot", snapshots.apply_change_set)
+    return cache
+
+data_registry = get_data_registry()
+sheet_cache = get_sheet_cache(REVISION_CHECK_INTERVAL)
+google_clients = connect_google(open_sheet=not sheet_cache.has(SHEET_TABS))
+if google_clients is None and not sheet_cache.has(SHEET_TABS):
+    st.error(f"Não consegui abrir a planilha: {get_google_connection_state()['error']}")
+    st.stop()
+sheet_cache.attach(google_clients)
+if google_clients is None:
+    loaded = min(sheet_cache.loaded_at(n) for n in SHEET_TABS)
+    st.warning(f"Planilha inacessível no momento. Usando a cópia local de {loaded:%d/%m/%Y %H:%M}.")
+
+def load_worksheets(names, force=False):
+    dfs, timings, errors = sheet_cache.get(names, force=force)
+    for name, e in errors.items():
+        st.warning(f"Aba '{name}' não pôde ser carregada: {e}")
+    return dfs, timings
+
+SQLITE_DATABASES = {"fichas": "fichas_tecnicas.db", "config": "configuracoes.db"}
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def table_columns(path, version, table):
+    """Colunas da tabela (PRAGMA table_info); lista vazia se a tabela não existe"""
+    with sqlite_pool.reader(path) as conn:
+        return [r[1] for r in conn.execute("SELECT * FROM pragma_table_info(?)", (table,))]
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def run_query(path, version, sql, params=()):
+    with sqlite_pool.reader(path) as conn:
+        return pd.read_sql_query(sql, conn, params=list(params))
+
+def query_sqlite(table, columns=None, where=(), order_by=(), after=None, limit=50, db="fichas"):
+    """SELECT com projeção, filtros, ordem e paginação resolvidos no próprio SQLite.
+
+    where: (coluna, operador, valor), operador em QUERY_OPERATORS ("IN" recebe uma sequência)
+    order_by: (coluna, "ASC"/"DESC"); NULL por último, rowid entra no fim como desempate
+    after: cursor devolvido pela página anterior (paginação por chave, sem OFFSET)
+
+    Nomes de tabela e coluna são conferidos com PRAGMA table_info e os valores vão
+    como parâmetros (a montagem fica em sqlite_query.build_select). O resultado fica
+    em cache por consulta e versão do arquivo.
+    Devolve (DataFrame da página, cursor da próxima página ou None).
+    """
+    path = SQLITE_DATABASES[db]
+    version = db_version(path)
+    known = table_columns(path, version, table)
+    if not known:
+        raise ValueError(f"Tabela desconhecida em {path}: {table}")
+    sql, params, key_cols = build_select(table, known, columns, where, order_by, after, limit)
+    return split_page(run_query(path, version, sql, tuple(params)), key_cols, limit)
+
+# Poucas entradas: cada versão do arquivo é uma tabela inteira em memória
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_sqlite_table(table_name, version, columns=None):
+    path = SQLITE_DATABASES["fichas"]
+    known = table_columns(path, version, table_name)
+    if not known:
+        raise sqlite3.OperationalError(f"no such table: {table_name}")
+    unknown = set(columns or ()) - set(known)
+    if unknown:
+        raise ValueError(f"Coluna desconhecida em {table_name}: {', '.join(sorted(unknown))}")
+    select = ", ".join(f'"{c}"' for c in (columns or known))
+    # Direto pelo pool, fora do cache do run_query, para não guardar a tabela duas vezes
+    with sqlite_pool.reader(path) as conn:
+        df = pd.read_sql_query(f'SELECT {select} FROM "{table_name}"', conn)
+    return apply_schema(table_name, df)
+
+def read_sqlite(table_name, columns=None):
+    """Tabela do fichas_tecnicas.db (só `columns`, se informadas); o cache se renova quando o arquivo muda.
+
+    Para filtros, ordem e páginas use query_sqlite, que resolve tudo no SQLite.
+    """
+    columns = tuple(columns) if columns else None
+    try:
+        return load_sqlite_table(table_name, db_version(SQLITE_DATABASES["fichas"]), columns)
     except Exception as e:
         if "no such table" in str(e).lower():
             try:
                 # Tenta inicializar e ler novamente uma única vez
                 init_db()
-                conn = sqlite3.connect('fichas_tecnicas.db')
-                df = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
-                conn.close()
-                return df
+                return load_sqlite_table(table_name, db_version(SQLITE_DATABASES["fichas"]), columns)
             except:
                 pass
         st.error(f"Erro ao ler banco de dados local ({table_name}): {e}")
@@ -715,37 +1771,26 @@ def read_sqlite(table_name):
 
 
 
-def refresh_data():
+def sync_session_data():
+    """Entrega à sessão os dados em cache sem esperar a rede; checagem e recarga rodam em segundo plano"""
+    st.session_state.data_version = data_registry.version
+    sheet_cache.refresh_async(SHEET_TABS)
+
+def refresh_data(force=False):
     """Atualiza todos os dados com feedback visual de progresso"""
     print(">>> Iniciando carregamento de dados...")
     progress_bar = st.sidebar.progress(0)
     status_text = st.sidebar.empty()
     
-    status_text.text('Carregando dados de erros...')
+    status_text.text(f'Carregando planilhas ({", ".join(SHEET_TABS)})...')
     progress_bar.progress(0.15)
-    st.session_state.erros_df = read_ws("erros")
-    print(f"    - Erros: {len(st.session_state.erros_df)} registros")
-    
-    
-    status_text.text('Carregando dados DACEN...')
-    progress_bar.progress(0.45)
-    st.session_state.dacen_df = read_ws("dacen")
-    print(f"    - DACEN: {len(st.session_state.dacen_df)} registros")
-    
-    status_text.text('Carregando dados PSI...')
-    progress_bar.progress(0.60)
-    st.session_state.psi_df = read_ws("psi")
-    print(f"    - PSI: {len(st.session_state.psi_df)} registros")
-    
-    status_text.text('Carregando dados gerais...')
-    progress_bar.progress(0.75)
-    st.session_state.gerais_df = read_ws("gerais")
-    print(f"    - Gerais: {len(st.session_state.gerais_df)} registros")
-    
-
-
+    dfs, timings = load_worksheets(tuple(SHEET_TABS), force=force)
+    st.session_state.data_version = data_registry.version
+    for name in SHEET_TABS:
+        t = timings.get(name, {})
+        print(f"    - {name}: {len(dfs[name])} registros (rede {t.get('rede_ms', '-')} ms, conversão {t.get('conversao_ms', '-')} ms)")
+    st.session_state.load_timings = timings
 
-    
     progress_bar.progress(1.0)
     status_text.text('Dados carregados com sucesso!')
     print(">>> Carregamento de dados concluído.")
@@ -753,39 +1798,435 @@ def refresh_data():
     progress_bar.empty()
     status_text.empty()
 
-def paginate_dataframe(df, page_size=20, key_prefix="page"):
-    """Helper to paginate a dataframe in the UI"""
-    if len(df) <= page_size:
+def parse_importtime(stderr_text):
+    """Converte a saída de `python -X importtime` em {módulo: (self_us, cumulativo_us)}"""
+    result = {}
+    for line in stderr_text.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+            result[name.strip()] = (int(self_us), int(cumulative_us))
+        except ValueError:
+            continue
+    return result
+
+@st.cache_data(show_spinner=False)
+def run_import_benchmark(modules):
+    """Mede, em processos limpos, o custo de importação de cada módulo pesado (como -X importtime)"""
+    rows = []
+    for name in list(modules) + ["streamlit", "pandas"]:
+        try:
+            res = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {name}"],
+                                 capture_output=True, text=True, timeout=120)
+            times = parse_importtime(res.stderr)
+            self_us, cumulative_us = times.get(name, (0, 0))
+            # Maiores dependências puxadas pelo módulo (exceto ele mesmo)
+            heaviest = sorted(((c, n) for n, (_, c) in times.items() if n != name), reverse=True)[:3]
+            rows.append({
+                "modulo": name,
+                "cumulativo_ms": round(cumulative_us / 1000, 1),
+                "proprio_ms": round(self_us / 1000, 1),
+                "sob_demanda": name in modules,
+                "maiores_dependencias": ", ".join(n.strip() for _, n in heaviest),
+            })
+        except Exception as e:
+            rows.append({"modulo": name, "cumulativo_ms": None, "proprio_ms": None,
+                         "sob_demanda": name in modules, "maiores_dependencias": f"erro: {e}"})
+    return pd.DataFrame(rows).sort_values("cumulativo_ms", ascending=False, na_position="last")
+
+FICHAS_SEARCH_COLUMNS = ["referencia", "produto", "decoracao", "obs"]
+# Peso de cada coluna no bm25, na ordem do índice: referência conta mais que observação
+FICHAS_FTS_WEIGHTS = (10.0, 2.0, 4.0, 1.0)
+
+def search_fichas_fts(text, limit=10):
+    """Fichas mais relevantes para o texto livre, pelo índice FTS5 (menor rank = melhor).
+
+    Cada termo vira prefixo ("1768" acha 17683); todos precisam aparecer, e se
+    nada casar a busca é refeita aceitando qualquer um deles.
+    """
+    terms = tokenize(text)
+    cols = ", ".join(f"f.{c}" for c in FICHAS_SEARCH_COLUMNS)
+    sql = (f"SELECT {cols}, bm25(fichas_fts, {', '.join(map(str, FICHAS_FTS_WEIGHTS))}) AS rank "
+           "FROM fichas_fts JOIN fichas f ON f.id = fichas_fts.rowid "
+           "WHERE fichas_fts MATCH ? ORDER BY rank LIMIT ?")
+    df = pd.DataFrame(columns=FICHAS_SEARCH_COLUMNS + ["rank"])
+    if not terms:
         return df
-    
-    total_pages = (len(df) - 1) // page_size + 1
-    page_num = st.number_input(f"Página (de {total_pages})", min_value=1, max_value=total_pages, step=1, key=f"{key_prefix}_num")
-    
-    start_idx = (page_num - 1) * page_size
-    end_idx = start_idx + page_size
-    
-    st.write(f"Mostrando {start_idx + 1} a {min(end_idx, len(df))} de {len(df)} registros")
-    return df.iloc[start_idx:end_idx]
+    with sqlite_pool.reader('fichas_tecnicas.db') as conn:
+        for op in (" ", " OR "):
+            # Aspas: termos como "0.5" não são interpretados como sintaxe do FTS5
+            df = pd.read_sql_query(sql, conn, params=(op.join(f'"{t}"*' for t in terms), int(limit)))
+            if not df.empty or len(terms) == 1:
+                break
+    return df
 
-def process_chat_request(prompt, dfs, image=None):
-    progress_container = st.empty()
-    status_container = st.empty()
-    
+LOOKUP_MAX_FICHAS = 200
+
+def lookup_references(codes, columns=None):
+    """Fichas das referências exatas, pelo índice idx_fichas_referencia (via query_sqlite, em cache por versão)"""
+    codes = list(dict.fromkeys(str(c).strip() for c in codes))
+    if not codes:
+        return pd.DataFrame()
+    df, _ = query_sqlite("fichas", columns=columns, where=[("referencia", "IN", codes)], limit=LOOKUP_MAX_FICHAS)
+    return df
+
+def benchmark_sqlite_lookups(rounds=200, per_run=5, workers=4):
+    """Consulta de ficha por referência: conexão nova a cada vez (como antes) x pool do processo.
+
+    Como no Streamlit, cada execução roda numa thread nova e faz `per_run` consultas;
+    as execuções rodam uma por vez e depois `workers` ao mesmo tempo.
+    """
+    path = SQLITE_DATABASES["fichas"]
+    with sqlite_pool.reader(path) as conn:
+        refs = [r[0] for r in conn.execute("SELECT referencia FROM fichas LIMIT 50")] or ["0"]
+    sql = "SELECT * FROM fichas WHERE referencia = ?"
+
+    def fresh(ref):
+        conn = sqlite3.connect(path)
+        try:
+            return conn.execute(sql, (ref,)).fetchall()
+        finally:
+            conn.close()
+
+    def pooled(ref):
+        with sqlite_pool.reader(path) as conn:
+            return conn.execute(sql, (ref,)).fetchall()
+
+    def script_run(fn, start):
+        for i in range(start, start + per_run):
+            fn(refs[i % len(refs)])
+
+    runs = max(rounds // per_run, 1)
+    rows = []
+    for scenario, parallel in (("execuções em sequência", 1), (f"{workers} execuções simultâneas", workers)):
+        base = None
+        for mode, fn in (("conexão nova", fresh), ("pool do processo (ro, mmap, statements)", pooled)):
+            t0 = time.perf_counter()
+            for first in range(0, runs, parallel):
+                threads = [threading.Thread(target=script_run, args=(fn, run * per_run))
+                           for run in range(first, min(first + parallel, runs))]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            us = round((time.perf_counter() - t0) / (runs * per_run) * 1e6, 1)
+            base = base or us
+            rows.append({"cenario": scenario, "modo": mode, "consultas": runs * per_run,
+                         "us_por_consulta": us, "ganho_x": round(base / max(us, 1e-9), 1)})
+    return pd.DataFrame(rows)
+
+def paginate_query(table, page_size=20, key_prefix="page", **query):
+    """Página atual de uma consulta (query_sqlite), navegando por cursor em vez de fatiar a tabela"""
+    signature = repr(sorted(query.items()))
+    if st.session_state.get(f"{key_prefix}_query") != signature:
+        # Filtro ou ordem mudaram: volta para a primeira página
+        st.session_state[f"{key_prefix}_query"] = signature
+        st.session_state[f"{key_prefix}_cursors"] = [None]
+    cursors = st.session_state[f"{key_prefix}_cursors"]
+    df, next_cursor = query_sqlite(table, after=cursors[-1], limit=page_size, **query)
+    col_prev, col_info, col_next = st.columns([1, 3, 1])
+    if col_prev.button("Anterior", key=f"{key_prefix}_prev", disabled=len(cursors) == 1):
+        cursors.pop()
+        st.rerun()
+    col_info.write(f"Página {len(cursors)} ({len(df)} registros)")
+    if col_next.button("Próxima", key=f"{key_prefix}_next", disabled=next_cursor is None):
+        cursors.append(next_cursor)
+        st.rerun()
+    return df
+
+# Resposta do Gemini renderizada conforme chega (False volta à chamada única)
+STREAMING_ENABLED = bool(st.secrets.get("STREAMING_ENABLED", True))
+GEMINI_MODEL = "gemini-flash-latest"
+
+# Modelo tentado na hora quando o principal estoura a cota (vazio = só retentativa)
+FALLBACK_MODEL = st.secrets.get("FALLBACK_MODEL", "")
+GEMINI_MAX_RETRIES = 4
+GEMINI_RETRY_BASE = 10  # s, quando o servidor não sugere espera
+
+def start_generation(full_prompt, make_config, model=GEMINI_MODEL, stream=None):
+    """Dispara a chamada ao Gemini; devolve um iterador de pedaços de texto.
+
+    Com streaming, o primeiro pedaço é puxado aqui para que erros de cota (429)
+    apareçam antes de qualquer coisa ser desenhada e possam ser retentados.
+    `make_config(model)` dá a config da chamada (instruções inline ou cache).
+    """
+    config = make_config(model)
+    data_tools = config.pop("data_tools", None)
+    if data_tools is not None:
+        # Laço de ferramentas: rodadas intermediárias não têm texto, a resposta sai inteira
+        models = LocalToolModel(router_text, REFERENCE_PATTERN) if CHAT_MODE == "ferramentas_local" else client.models
+        return iter([run_tool_loop(models, model, full_prompt, config, data_tools)])
+    if not (STREAMING_ENABLED if stream is None else stream):
+        resp = client.models.generate_content(model=model, contents=full_prompt, config=config)
+        return iter([resp.text or ""])
+    stream = iter(client.models.generate_content_stream(model=model, contents=full_prompt, config=config))
+    first = next(stream, None)
+    rest = (chunk.text or "" for chunk in stream)
+    if first is None:
+        return rest
+    return itertools.chain([first.text or ""], rest)
+
+def gemini_retry_delay(e, attempt):
+    """Espera sugerida pelo servidor (Retry-After ou RetryInfo.retryDelay); senão backoff exponencial"""
+    hinted = retry_after_seconds(e)
+    if hinted is None:
+        m = re.search(r"retryDelay['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)s", str(e))
+        hinted = float(m.group(1)) if m else None
+    return hinted if hinted is not None else GEMINI_RETRY_BASE * 2 ** attempt
+
+class GeminiRetryScheduler:
+    """Retentativas de 429 fora da thread do script.
+
+    A pergunta vai para um worker que espera o tempo sugerido pelo servidor e
+    tenta de novo; a sessão guarda só o Future e confere de tempos em tempos,
+    então a interface continua respondendo enquanto isso.
+    """
+
+    def __init__(self, workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gemini-retry")
+        self.lock = threading.Lock()
+        self.stats = {"erros_429": 0, "fallback_ok": 0, "agendadas": 0, "retentativas": 0,
+                      "sucesso_apos_espera": 0, "desistencias": 0, "espera_total_s": 0.0}
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def schedule(self, full_prompt, make_config, error):
+        self.count("agendadas")
+        return self.executor.submit(self._run, list(full_prompt), make_config, error)
+
+    def _run(self, full_prompt, make_config, error):
+        for attempt in range(GEMINI_MAX_RETRIES):
+            delay = gemini_retry_delay(error, attempt)
+            self.count("espera_total_s", delay)
+            time.sleep(delay)
+            self.count("retentativas")
+            try:
+                text = "".join(start_generation(full_prompt, make_config, stream=False))
+            except Exception as e:
+                if not is_rate_limit_error(e):
+                    raise
+                self.count("erros_429")
+                error = e
+                continue
+            self.count("sucesso_apos_espera")
+            return text
+        self.count("desistencias")
+        raise error
+
+@st.cache_resource
+def get_gemini_retries():
+    return GeminiRetryScheduler()
+
+gemini_retries = get_gemini_retries()
+
+def generate_or_schedule(prompt, full_prompt, make_config):
+    """Tenta o modelo principal e, no 429, o alternativo; se ambos estiverem sem
+    cota, agenda a retentativa em segundo plano e devolve None."""
     try:
-        with progress_container:
-            progress_bar = st.progress(0)
-        
-        with status_container:
-            st.info('Preparando contexto dos dados...')
-        progress_bar.progress(0.20)
-        
-        with status_container:
-            st.info('Processando...')
-        progress_bar.progress(0.40)
-        context = build_context(dfs)
-        
-        # Instruções de sistema para o modelo
-        system_instruction = f'''
+        return start_generation(full_prompt, make_config)
+    except Exception as e:
+        if not is_rate_limit_error(e):
+            raise
+        gemini_retries.count("erros_429")
+        error = e
+    if FALLBACK_MODEL:
+        try:
+            chunks = start_generation(full_prompt, make_config, model=FALLBACK_MODEL)
+            gemini_retries.count("fallback_ok")
+            return chunks
+        except Exception as e:
+            if not is_rate_limit_error(e):
+                raise
+            gemini_retries.count("erros_429")
+            error = e
+    st.session_state.pending_chat = {
+        "prompt": prompt,
+        "future": gemini_retries.schedule(full_prompt, make_config, error),
+        "since": time.time(),
+        "espera_s": gemini_retry_delay(error, 0),
+    }
+    return None
+
+ANSWER_CACHE_DB = "answer_cache.db"
+ANSWER_CACHE_TTL = float(st.secrets.get("ANSWER_CACHE_TTL_HOURS", 24)) * 3600
+ANSWER_CACHE_MAX = int(st.secrets.get("ANSWER_CACHE_MAX", 500))
+
+def normalize_prompt(prompt):
+    """Pergunta sem acentos, caixa, pontuação e espaços repetidos"""
+    return " ".join(re.sub(r"[^\w\s]", " ", normalize_text(prompt)).split())
+
+# Fotos de celular (8-12 MP) são reduzidas antes de ir para a tela e para o Gemini
+IMAGE_MAX_SIDE = int(st.secrets.get("IMAGE_MAX_SIDE", 1600))
+IMAGE_QUALITY = 80
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def prepare_image(raw):
+    """Gira conforme o EXIF, limita o maior lado, descarta metadados e recodifica em WebP.
+
+    Devolve {"data", "mime_type", "digest", "size", "report"}; o digest (sha256 do
+    resultado) entra na chave do cache de respostas, e o mesmo arquivo enviado de
+    novo não é reprocessado.
+    """
+    t0 = time.perf_counter()
+    img = PIL_Image.open(io.BytesIO(raw))
+    original_size, original_bands = img.size, len(img.getbands())
+    img = PIL_ImageOps.exif_transpose(img)
+    img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), PIL_Image.Resampling.LANCZOS)
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "transparency" in img.info or "A" in img.getbands() else "RGB")
+    buf = io.BytesIO()
+    img.save(buf, format="WEBP", quality=IMAGE_QUALITY, method=4)
+    data = buf.getvalue()
+    report = {
+        "original_kb": round(len(raw) / 1024, 1),
+        "original_px": f"{original_size[0]}x{original_size[1]}",
+        "original_memoria_mb": round(original_size[0] * original_size[1] * original_bands / 2**20, 1),
+        "enviada_kb": round(len(data) / 1024, 1),
+        "enviada_px": f"{img.size[0]}x{img.size[1]}",
+        "enviada_memoria_mb": round(img.size[0] * img.size[1] * len(img.getbands()) / 2**20, 1),
+        "reducao_%": round(100 * (1 - len(data) / len(raw)), 1) if raw else 0.0,
+        "preparo_ms": round((time.perf_counter() - t0) * 1000, 1),
+    }
+    return {"data": data, "mime_type": "image/webp", "digest": hashlib.sha256(data).hexdigest(),
+            "size": img.size, "report": report}
+
+def image_part(image):
+    return genai.types.Part.from_bytes(data=image["data"], mime_type=image["mime_type"])
+
+class AnswerCache:
+    """Respostas já dadas, em SQLite, para perguntas repetidas.
+
+    A chave junta a pergunta normalizada, a versão de conteúdo de cada tabela
+    usada no contexto e o hash da imagem. `answer_deps` guarda de quais versões
+    cada resposta depende: quando o registro publica uma tabela nova, as
+    respostas presas à versão antiga são apagadas. Além disso há validade (TTL)
+    e um limite de entradas, descartando as menos usadas recentemente.
+    """
+    def __init__(self, path, ttl, max_entries):
+        self.path, self.ttl, self.max_entries = path, ttl, max_entries
+        self._lock = threading.Lock()
+        self.stats = {"acertos": 0, "faltas": 0, "gravadas": 0, "invalidadas": 0, "expiradas": 0}
+        conn = sqlite3.connect(self.path)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS answers (
+                key TEXT PRIMARY KEY,
+                prompt TEXT,
+                answer TEXT,
+                created_at REAL,
+                last_hit REAL,
+                hits INTEGER DEFAULT 0
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS answer_deps (
+                key TEXT,
+                tabela TEXT,
+                versao TEXT
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_answer_deps_tabela ON answer_deps(tabela)")
+        conn.commit()
+        conn.close()
+
+    @staticmethod
+    def make_key(prompt, versions, image_hash=""):
+        payload = json.dumps({"prompt": normalize_prompt(prompt), "versions": versions, "image": image_hash},
+                             sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            conn = sqlite3.connect(self.path)
+            row = conn.execute("SELECT answer, created_at FROM answers WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] > self.ttl:
+                self._delete(conn, "SELECT ?", (key,))
+                conn.commit()
+                self.stats["expiradas"] += 1
+                row = None
+            if row:
+                conn.execute("UPDATE answers SET last_hit = ?, hits = hits + 1 WHERE key = ?", (now, key))
+                conn.commit()
+            conn.close()
+        self.stats["acertos" if row else "faltas"] += 1
+        return row[0] if row else None
+
+    def put(self, key, prompt, answer, versions):
+        now = time.time()
+        with self._lock:
+            conn = sqlite3.connect(self.path)
+            self._delete(conn, "SELECT ?", (key,))
+            conn.execute("INSERT INTO answers (key, prompt, answer, created_at, last_hit) VALUES (?, ?, ?, ?, ?)",
+                         (key, prompt, answer, now, now))
+            conn.executemany("INSERT INTO answer_deps (key, tabela, versao) VALUES (?, ?, ?)",
+                             [(key, name, version) for name, version in versions.items()])
+            self._evict(conn, now)
+            conn.commit()
+            conn.close()
+        self.stats["gravadas"] += 1
+
+    def invalidate(self, cs, df=None):
+        """Inscrito no registro: apaga as respostas que dependem de outra versão da tabela"""
+        with self._lock:
+            conn = sqlite3.connect(self.path)
+            removed = self._delete(conn, "SELECT key FROM answer_deps WHERE tabela = ? AND versao <> ?",
+                                   (cs.table, cs.new_version))
+            conn.commit()
+            conn.close()
+        self.stats["invalidadas"] += removed
+
+    def purge_stale(self, registry):
+        """Na subida do processo: descarta o que foi respondido com dados que já mudaram"""
+        _, tables = registry.current()
+        for name in tables:
+            self.invalidate(ChangeSet(name, None, registry.table_version(name), [], [], [], True))
+
+    def _evict(self, conn, now):
+        expired = self._delete(conn, "SELECT key FROM answers WHERE created_at < ?", (now - self.ttl,))
+        self.stats["expiradas"] += expired
+        self._delete(conn, "SELECT key FROM answers ORDER BY last_hit DESC LIMIT -1 OFFSET ?",
+                     (self.max_entries,))
+
+    @staticmethod
+    def _delete(conn, keys_query, params):
+        keys = [r[0] for r in conn.execute(keys_query, params).fetchall()]
+        conn.executemany("DELETE FROM answers WHERE key = ?", [(k,) for k in keys])
+        conn.executemany("DELETE FROM answer_deps WHERE key = ?", [(k,) for k in keys])
+        return len(keys)
+
+    def __len__(self):
+        conn = sqlite3.connect(self.path)
+        n = conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        conn.close()
+        return n
+
+@st.cache_resource(show_spinner=False)
+def get_answer_cache(path, ttl, max_entries):
+    cache = AnswerCache(path, ttl, max_entries)
+    registry = get_data_registry()
+    cache.purge_stale(registry)
+    registry.subscribe("answer_cache", cache.invalidate)
+    return cache
+
+answer_cache = get_answer_cache(ANSWER_CACHE_DB, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX)
+
+# "contexto" manda as linhas no prompt; "ferramentas" deixa o Gemini consultar os dados por
+# function calling; "ferramentas_local" roda o mesmo laço com um modelo local, sem rede
+CHAT_MODE = st.secrets.get("CHAT_MODE", "contexto")
+
+# Cache de contexto no servidor: "off" reenvia tudo a cada pergunta, "server" usa
+# client.caches do Gemini, "local" imita o servidor em memória para testar offline
+CONTEXT_CACHE_MODE = st.secrets.get("CONTEXT_CACHE_MODE", "off")
+CONTEXT_CACHE_TTL = int(st.secrets.get("CONTEXT_CACHE_TTL", 3600))  # s
+# Linhas relevantes à pergunta enviadas junto dela quando o bloco de dados está em cache
+CONTEXT_CACHE_EXTRA_CHARS = 4000
+
+def system_instruction_for(context):
+    """Instruções de sistema para o modelo, com o bloco de dados no fim"""
+    return f'''
         Você é o Assistente Técnico PlasPrint IA especializado em flexografia e impressão industrial.
         Responda em português brasileiro de forma estritamente técnica e direta.
         **NUNCA use saudações, introduções ou frases de cortesia.**
@@ -819,53 +2260,309 @@ def process_chat_request(prompt, dfs, image=None):
         CONTEXTO DOS DADOS:
         {context}
         '''
+
+class GeminiContextCacheBackend:
+    """Conteúdo guardado no próprio Gemini (client.caches), referenciado pelo nome"""
+
+    def create(self, model, system_instruction, ttl):
+        cached = client.caches.create(model=model, config={
+            "system_instruction": system_instruction,
+            "ttl": f"{int(ttl)}s",
+            "display_name": "plasprint-contexto",
+        })
+        return cached.name
+
+    def config(self, handle):
+        return {"cached_content": handle}
+
+    def delete(self, handle):
+        client.caches.delete(name=handle)
+
+class LocalContextCacheBackend:
+    """Imitação local de client.caches: guarda o texto e devolve um handle.
+
+    Serve para exercitar criação, reaproveitamento e expiração sem rede; na
+    geração o texto volta inline, então nada é economizado de verdade.
+    """
+
+    def __init__(self):
+        self.store = {}
+
+    def create(self, model, system_instruction, ttl):
+        handle = f"local/{model}/{hashlib.sha1(system_instruction.encode()).hexdigest()[:12]}"
+        self.store[handle] = system_instruction
+        return handle
+
+    def config(self, handle):
+        return {"system_instruction": self.store[handle]}
+
+    def delete(self, handle):
+        self.store.pop(handle, None)
+
+class ContextCacheManager:
+    """Um conteúdo em cache por modelo, recriado só quando a versão dos dados muda.
+
+    As instruções de sistema mais o bloco de dados (montado sem depender da
+    pergunta) sobem uma vez por versão dos dados; as perguntas seguintes mandam
+    apenas o handle. Se a criação falhar (modelo sem suporte, contexto pequeno
+    demais para o mínimo da API), devolve None por GOOGLE_RETRY_INTERVAL e o
+    chamador envia o texto inline.
+    """
+
+    def __init__(self, backend, ttl):
+        self.backend, self.ttl = backend, ttl
+        self._lock = threading.Lock()
+        self.entries = {}  # modelo -> {"data_key", "handle", "expires", "chars"}
+        self.stats = {"criados": 0, "reutilizados": 0, "falhas": 0, "caracteres_poupados": 0}
+
+    def config_for(self, model, data_key, build_instruction):
+        now = time.time()
+        with self._lock:
+            entry = self.entries.get(model)
+            if entry and entry["data_key"] == data_key:
+                if entry["handle"] and entry["expires"] > now + 60:
+                    self.stats["reutilizados"] += 1
+                    self.stats["caracteres_poupados"] += entry["chars"]
+                    return self.backend.config(entry["handle"])
+                if not entry["handle"] and entry["expires"] > now:
+                    return None
+            if entry and entry["handle"]:
+                try:
+                    self.backend.delete(entry["handle"])
+                except Exception as e:
+                    print(f"    ! Não consegui apagar o contexto em cache {entry['handle']}: {e}")
+            instruction = build_instruction()
+            try:
+                handle = self.backend.create(model, instruction, self.ttl)
+            except Exception as e:
+                print(f"    ! Cache de contexto indisponível para {model}: {e}")
+                self.stats["falhas"] += 1
+                self.entries[model] = {"data_key": data_key, "handle": None,
+                                       "expires": now + GOOGLE_RETRY_INTERVAL, "chars": 0}
+                return None
+            self.stats["criados"] += 1
+            self.entries[model] = {"data_key": data_key, "handle": handle,
+                                   "expires": now + self.ttl, "chars": len(instruction)}
+            return self.backend.config(handle)
+
+@st.cache_resource(show_spinner=False)
+def get_context_cache(mode, ttl):
+    backends = {"server": GeminiContextCacheBackend, "local": LocalContextCacheBackend}
+    if mode not in backends:
+        return None
+    return ContextCacheManager(backends[mode](), ttl)
+
+context_cache = get_context_cache(CONTEXT_CACHE_MODE, CONTEXT_CACHE_TTL)
+
+# Consultas diretas às fichas técnicas, respondidas sem o Gemini
+FAST_ROUTER_ENABLED = bool(st.secrets.get("FAST_ROUTER_ENABLED", True))
+INK_COLUMNS = ["cyan", "magenta", "yellow", "black", "white", "varnish"]
+# palavra-chave (normalizada) -> colunas da ficha
+FICHA_KEYWORDS = {
+    "tempo": ["tempo_s"], "ciclo": ["tempo_s"],
+    "consumo": INK_COLUMNS, "tinta": INK_COLUMNS, "tintas": INK_COLUMNS,
+    "cyan": ["cyan"], "ciano": ["cyan"], "magenta": ["magenta"], "yellow": ["yellow"], "amarelo": ["yellow"],
+    "black": ["black"], "preto": ["black"], "white": ["white"], "branco": ["white"],
+    "varnish": ["varnish"], "verniz": ["varnish"],
+    "largura": ["largura"], "altura": ["altura"], "diametro": ["diametro"],
+    "print edge": ["print_edge"], "borda": ["print_edge"], "powergrade": ["powergrade"],
+    "finish": ["finish_time"], "intervalo": ["intervalo"], "uv": ["uv_lamp"], "lampada": ["uv_lamp"],
+    "ficha": FICHAS_PARAM_COLUMNS, "parametros": FICHAS_PARAM_COLUMNS, "configuracao": FICHAS_PARAM_COLUMNS,
+}
+FICHA_LABELS = {
+    "tempo_s": ("Tempo de ciclo", "s"), "largura": ("Largura", "mm"), "altura": ("Altura", "mm"),
+    "diametro": ("Diâmetro", "mm"), "print_edge": ("Print edge", ""), "powergrade": ("Powergrade", ""),
+    "finish_time": ("Finish time", ""), "intervalo": ("Intervalo", ""), "uv_lamp": ("Lâmpada UV", "%"),
+}
+# Perguntas que pedem análise ou explicação seguem para o Gemini mesmo citando uma referência
+OPEN_ENDED_MARKERS = ("por que", "porque", "como", "explique", "explica", "analise", "analisa", "compare",
+                      "compara", "diferenca", "melhor", "sugest", "recomend", "problema", "defeito", "erro",
+                      "oee", "eficiencia", "ajust", "devo", "causa",
+                      # mídia: o modelo resolve os links das colunas de imagem/vídeo
+                      "imagem", "foto", "link", "video")
+REFERENCE_PATTERN = re.compile(r"\b\d{3,6}\b")
+
+def router_text(text):
+    """Pergunta normalizada, com "600 ml" e "600ml" escritos do mesmo jeito"""
+    return re.sub(r"(\d)\s+(ml|l)\b", r"\1\2", normalize_prompt(text))
+
+def format_number(value):
+    return f"{round(float(value), 3):g}"
+
+def present(value):
+    """Célula com conteúdo (nem NaN/None, nem texto em branco)"""
+    return pd.notna(value) and str(value).strip() != ""
+
+def format_ficha(row, columns):
+    decoracao = row.get("decoracao")
+    lines = [f"**Referência {row['referencia']}** — {row['produto']} · Decoração: {decoracao if present(decoracao) else '-'}"]
+    image = row.get("image_path")
+    if present(image) and str(image).startswith(("http://", "https://")):
+        # Mesmo formato exigido do modelo, em bloco próprio, para render_smart_response mostrar a imagem
+        lines += ["", f"Link de Imagem: {str(image).strip()}"]
+    lines += ["", "| Parâmetro | Valor |", "|---|---|"]
+    for col in columns:
+        value = row[col]
+        if pd.isna(value):
+            continue
+        if col in INK_COLUMNS:
+            text = f"{format_number(value)} ml/garrafa · {format_number(value * 1000)} ml/milheiro"
+            lines.append(f"| {col.capitalize()} | {text} |")
+        else:
+            label, unit = FICHA_LABELS[col]
+            lines.append(f"| {label} | {format_number(value)} {unit}".rstrip() + " |")
+    if present(row.get("obs")):
+        lines += ["", f"Observações: {' '.join(str(row['obs']).split())}"]
+    return "\n".join(lines)
+
+def route_structured_query(prompt, dfs, image=None):
+    """Responde consultas diretas (parâmetro X da referência Y, tempo padrão do
+    produto Z) com uma tabela markdown montada a partir das fichas; devolve None
+    quando a pergunta é aberta e precisa do modelo."""
+    if not FAST_ROUTER_ENABLED or image is not None:
+        return None
+    text = router_text(prompt)
+    if any(re.search(rf"\b{marker}", text) for marker in OPEN_ENDED_MARKERS):
+        return None
+    columns = []
+    for keyword, cols in FICHA_KEYWORDS.items():
+        if re.search(rf"\b{keyword}\b", text):
+            columns += [c for c in cols if c not in columns]
+    if not columns:
+        return None
+
+    fichas = dfs.get("fichas", pd.DataFrame())
+    codes = REFERENCE_PATTERN.findall(text)
+    if codes and not fichas.empty:
+        rows = lookup_references(codes)
+        if rows.empty:
+            return None
+        columns = [c for c in FICHAS_PARAM_COLUMNS if c in columns and c in rows.columns]
+        return "\n\n".join(format_ficha(row, columns) for row in rows.to_dict("records"))
+
+    if "tempo_s" in columns:
+        try:
+            produtos, _ = query_sqlite("produtos", columns=("nome", "tempo_padrao"), limit=10000)
+        except (ValueError, sqlite3.Error):
+            return None
+        if produtos.empty:
+            return None
+        names = produtos["nome"].astype(str).map(router_text)
+        hits = produtos[[bool(name) and name in text for name in names]]
+        if hits.empty:
+            return None
+        lines = ["| Produto | Tempo padrão |", "|---|---|"]
+        lines += [f"| {row['nome']} | {format_number(row['tempo_padrao'])} s |" for row in hits.to_dict("records")]
+        return "\n".join(lines)
+    return None
+
+@st.cache_resource(show_spinner=False)
+def get_router_stats():
+    return {"respondidas": 0, "repassadas": 0, "tempo_total_ms": 0.0}
+
+def process_chat_request(prompt, dfs, image=None):
+    progress_container = st.empty()
+    status_container = st.empty()
+    
+    try:
+        router_t0 = time.perf_counter()
+        routed = route_structured_query(prompt, dfs, image)
+        router_stats = get_router_stats()
+        router_stats["tempo_total_ms"] += (time.perf_counter() - router_t0) * 1000
+        if routed is not None:
+            # Consulta direta às fichas: tabela montada localmente, sem chamar o Gemini
+            router_stats["respondidas"] += 1
+            # Como as respostas do modelo: "Link de Imagem:" vira a imagem (sem tirar o ** do título)
+            render_smart_response(routed, strip_bullets=False)
+            st.caption("Resposta direta das fichas técnicas.")
+            return
+        router_stats["repassadas"] += 1
+
+        versions = {name: data_registry.table_version(name) for name, df in dfs.items() if not df.empty}
+        cache_key = AnswerCache.make_key(prompt, versions, image["digest"] if image else "")
+        cached = answer_cache.get(cache_key)
+        if cached is not None:
+            # Mesma pergunta sobre os mesmos dados: responde na hora, sem chamar o Gemini
+            renderer = StreamRenderer()
+            renderer.feed(cached)
+            renderer.close()
+            st.caption("Resposta reaproveitada (dados inalterados desde a última vez).")
+            return
+
+        with progress_container:
+            progress_bar = st.progress(0)
         
+        with status_container:
+            st.info('Preparando contexto dos dados...')
+        progress_bar.progress(0.20)
+        
+        with status_container:
+            st.info('Processando...')
+        progress_bar.progress(0.40)
+        context_report = {}
         full_prompt = [prompt]
+        data_tools = None
+        if CHAT_MODE in ("ferramentas", "ferramentas_local"):
+            # Só o catálogo das tabelas vai no prompt; as linhas vêm pelas ferramentas
+            data_tools = DataTools(dfs)
+            system_instruction = system_instruction_for(data_tools.catalog())
+            make_config = lambda model: {"system_instruction": system_instruction,
+                                         "tools": [{"function_declarations": DATA_TOOL_DECLARATIONS}],
+                                         "automatic_function_calling": {"disable": True},
+                                         "data_tools": data_tools}
+        elif context_cache is None:
+            system_instruction = system_instruction_for(build_context(dfs, prompt=prompt, report=context_report))
+            make_config = lambda model: {"system_instruction": system_instruction}
+        else:
+            # Bloco de dados fixo em cache; só as linhas mais relevantes vão com a pergunta
+            data_key = hashlib.sha1(json.dumps(versions, sort_keys=True).encode()).hexdigest()[:12]
+            static = {}
+            def static_instruction():
+                if "text" not in static:
+                    static["text"] = system_instruction_for(build_context(dfs))
+                return static["text"]
+            make_config = lambda model: (context_cache.config_for(model, data_key, static_instruction)
+                                         or {"system_instruction": static_instruction()})
+            relevant = build_context(dfs, max_chars=CONTEXT_CACHE_EXTRA_CHARS, prompt=prompt, report=context_report)
+            full_prompt = [f"LINHAS MAIS RELEVANTES PARA A PERGUNTA:\n{relevant}\n\nPERGUNTA: {prompt}"]
+        st.session_state.last_context_report = context_report
+        
         if image:
-            full_prompt.append(image)
+            full_prompt.append(image_part(image))
             with status_container:
                 st.info('Analisando imagem enviada...')
         
-        # Sistema de retry para lidar com 429 RESOURCE_EXHAUSTED
-        max_retries = 5
-        retry_delay = 10 # segundos iniciais
-        resp = None
+        llm_t0 = time.perf_counter()
+        chunks = generate_or_schedule(prompt, full_prompt, make_config)
+        if chunks is None:
+            progress_container.empty()
+            status_container.empty()
+            st.session_state.pending_chat.update(cache_key=cache_key, versions=versions)
+            st.info(f"Limite de uso temporário atingido. A resposta será buscada de novo em "
+                    f"~{st.session_state.pending_chat['espera_s']:.0f}s; o app continua disponível enquanto isso.")
+            return
+        first_token = time.perf_counter() - llm_t0
         
-        for attempt in range(max_retries):
-            try:
-                # Tenta usar o modelo Flash mais recente disponível
-                resp = client.models.generate_content(
-                    model="gemini-flash-latest", 
-                    contents=full_prompt,
-                    config={"system_instruction": system_instruction}
-                )
-                break # Sucesso, sai do loop
-            except Exception as e:
-                err_str = str(e).upper()
-                if "429" in err_str and attempt < max_retries - 1:
-                    # Se atingir o limite, esperamos o tempo de backoff
-                    with status_container:
-                        st.warning(f"Limite de uso temporário atingido. Aguardando {retry_delay}s para liberar... (Tentativa {attempt + 1}/{max_retries})")
-                    time.sleep(retry_delay)
-                    retry_delay *= 2 # Espera progressivamente mais
-                else:
-                    raise e # Erro fatal ou última tentativa falhou
-        
-        with status_container:
-            st.info('Formatando resposta...')
-        progress_bar.progress(0.90)
-
-        # Limpeza mínima: apenas links de imagem redundantes se houver
-        clean_text = re.sub(r'Links de imagens:?', '', resp.text, flags=re.IGNORECASE)
-        
-        # Limpar indicadores de progresso
+        # Limpar indicadores de progresso: a resposta ocupa o lugar deles
         progress_bar.progress(1.0)
-        time.sleep(0.3)
         progress_container.empty()
         status_container.empty()
         
-        # Renderização Inteligente: Texto + Mídia intercalados
-        render_smart_response(clean_text)
+        # Renderização Inteligente: Texto + Mídia intercalados, bloco a bloco
+        renderer = StreamRenderer()
+        for chunk in chunks:
+            renderer.feed(chunk)
+        renderer.close()
+        if renderer.text.strip():
+            answer_cache.put(cache_key, prompt, renderer.text, versions)
+        
+        total = time.perf_counter() - llm_t0
+        formats = "+".join(sorted({r["formato"] for r in context_report.values()})) or "vazio"
+        get_llm_latency_stats()[formats].append(total)
+        if data_tools is not None:
+            st.session_state.last_tool_calls = data_tools.trace
+        st.session_state.last_llm_timing = {"primeiro_texto_s": round(first_token, 2), "total_s": round(total, 2),
+                                            "streaming": STREAMING_ENABLED, "blocos": renderer.blocks}
 
     except Exception as e:
         if "progress_container" in locals() and progress_container: progress_container.empty()
@@ -873,42 +2570,646 @@ def process_chat_request(prompt, dfs, image=None):
         st.error(f"Erro ao processar: {e}")
         st.warning('Dica: Tente reformular sua pergunta ou verifique sua conexão.')
 
-if any(k not in st.session_state for k in ["erros_df", "trabalhos_df", "dacen_df", "psi_df", "gerais_df"]):
+if sheet_cache.has(SHEET_TABS):
+    sync_session_data()
+else:
     with st.spinner('Carregando dados iniciais do sistema...'):
         refresh_data()
 
+# Fichas técnicas (SQLite) entram no mesmo registro, para busca e versionamento
+if "fichas" not in data_registry.current()[1]:
+    data_registry.publish({"fichas": read_sqlite("fichas")})
+
+# Gravado pelo sync_db.py a cada troca do fichas_tecnicas.db
+DB_VERSION_FILE = "fichas_tecnicas.db.version"
+
+def read_db_sync_version():
+    try:
+        with open(DB_VERSION_FILE, encoding="utf-8") as f:
+            return json.load(f).get("version")
+    except (OSError, ValueError):
+        return None
+
+@st.cache_resource(show_spinner=False)
+def get_db_sync_state():
+    return {"version": read_db_sync_version(), "lock": threading.Lock()}
+
+def check_db_swap():
+    """Banco trocado pelo sync_db.py: recria o índice FTS e republica as fichas.
+
+    Roda a cada execução do script (e no watch_data_version). Só o que vem do banco
+    é refeito: as conexões do pool e as consultas em cache já trocam de arquivo pela
+    identidade/`.version`, e a republicação invalida (pelo registro) apenas o que
+    depende da tabela fichas. Planilhas e demais caches ficam como estão.
+    """
+    state = get_db_sync_state()
+    version = read_db_sync_version()
+    if version == state["version"]:
+        return False
+    with state["lock"]:
+        if version == state["version"]:
+            return False
+        init_db()
+        data_registry.publish({"fichas": read_sqlite("fichas")})
+        state["version"] = version
+    return True
+
+check_db_swap()
+
+@st.fragment(run_every=DATA_WATCH_INTERVAL)
+def watch_data_version():
+    # Busca dados novos em segundo plano sem recarregar a página (a resposta na tela
+    # ficaria em branco); cada execução lê data_registry.current(), então a próxima
+    # interação já usa a versão nova
+    sheet_cache.refresh_async(SHEET_TABS)
+    check_db_swap()
+    if data_registry.version != st.session_state.get("data_version"):
+        st.caption("Dados novos disponíveis: serão usados na próxima pergunta.")
+
+watch_data_version()
+
+# Visão consistente das tabelas para toda esta execução do script
+_, tables = data_registry.current()
+
 st.sidebar.header("Dados carregados")
-st.sidebar.write("erros:", len(st.session_state.get("erros_df", [])))
-st.sidebar.write("trabalhos:", len(st.session_state.get("trabalhos_df", [])))
-st.sidebar.write("dacen:", len(st.session_state.get("dacen_df", [])))
-st.sidebar.write("psi:", len(st.session_state.get("psi_df", [])))
-st.sidebar.write("gerais:", len(st.session_state.get("gerais_df", [])))
+st.sidebar.write("erros:", len(tables.get("erros", [])))
+st.sidebar.write("trabalhos:", 0)
+st.sidebar.write("dacen:", len(tables.get("dacen", [])))
+st.sidebar.write("psi:", len(tables.get("psi", [])))
+st.sidebar.write("gerais:", len(tables.get("gerais", [])))
 
 
 if st.sidebar.button("Atualizar Dados"):
     with st.spinner('Atualizando dados...'):
-        refresh_data()
+        refresh_data(force=True)
     st.success('Dados atualizados!')
     time.sleep(0.5)
     st.rerun()
 
-
 os.environ["GEMINI_API_KEY"] = GEMINI_API_KEY
-client = genai.Client()
-
-def build_context(dfs, max_chars=30000):
-    parts = []
+# O SDK do Gemini só é importado quando a primeira pergunta chega ao modelo
+client = LazyObject(lambda: get_genai_client(GEMINI_API_KEY))
+
+# ===== Recuperação de linhas relevantes (BM25) =====
+STOPWORDS = {"de", "da", "do", "das", "dos", "em", "no", "na", "nos", "nas", "para", "por", "com",
+             "um", "uma", "os", "as", "ao", "aos", "que", "qual", "quais", "se", "como", "e", "o", "a",
+             "me", "meu", "minha", "ser", "sao", "esta", "isso", "esse", "essa", "tem", "sobre"}
+
+def tokenize(text):
+    tokens = re.findall(r"[a-z0-9]+(?:[.,][0-9]+)?", normalize_text(text))
+    return [t for t in tokens if t not in STOPWORDS and (len(t) > 1 or t.isdigit())]
+
+def format_row_fragment(record):
+    """Linha no formato 'coluna: valor | ...', ignorando células vazias"""
+    return " | ".join(f"{k}: {v}" for k, v in record.items() if not pd.isna(v) and str(v).strip() != '')
+
+class RowIndex:
+    """Índice invertido BM25 sobre as linhas de todas as tabelas do DataRegistry.
+
+    Cada documento é (tabela, posição da linha). O índice é atualizado pelos ChangeSets
+    do registro, então uma linha alterada reindexa só ela. Os nomes das colunas formam
+    um documento por tabela: uma pergunta que cita uma coluna ("OEE", "turno") puxa as
+    linhas da tabela, com a pontuação do cabeçalho dividida entre elas.
+    """
+    K1, B = 1.5, 0.75
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.postings = defaultdict(dict)  # termo -> {doc: tf}
+        self.doc_terms = {}  # doc -> Counter, para remover/atualizar a linha
+        self.doc_len = {}
+        self.total_len = 0
+        self.frames = {}  # tabela -> DataFrame indexado
+        self.versions = {}  # tabela -> versão de conteúdo indexada
+        self.headers = {}  # tabela -> termos dos nomes das colunas
+
+    def _add_doc(self, doc, text):
+        terms = Counter(tokenize(text))
+        self.doc_terms[doc] = terms
+        self.doc_len[doc] = sum(terms.values())
+        self.total_len += self.doc_len[doc]
+        for term, tf in terms.items():
+            self.postings[term][doc] = tf
+
+    def _remove_doc(self, doc):
+        terms = self.doc_terms.pop(doc, None)
+        if terms is None:
+            return
+        self.total_len -= self.doc_len.pop(doc)
+        for term in terms:
+            docs = self.postings.get(term)
+            if docs is not None:
+                docs.pop(doc, None)
+                if not docs:
+                    del self.postings[term]
+
+    def _row_texts(self, df, positions):
+        # Vazios (NaN/<NA>) viram "" para não indexar o termo "nan"
+        rows = widen_for_display(df.iloc[positions]).astype(object)
+        rows = rows.where(rows.notna(), "")
+        return [" ".join(str(v) for v in r) for r in rows.itertuples(index=False, name=None)]
+
+    def index_table(self, name, df, version=None):
+        with self._lock:
+            for doc in [d for d in self.doc_terms if d[0] == name]:
+                self._remove_doc(doc)
+            if len(df.columns):
+                for pos, text in enumerate(self._row_texts(df, list(range(len(df))))):
+                    self._add_doc((name, pos), text)
+            self.headers[name] = set(tokenize(" ".join(map(str, df.columns))))
+            self.frames[name] = df
+            self.versions[name] = version
+
+    def apply_change_set(self, cs, df):
+        """Consumidor do DataRegistry: reindexa só as linhas do ChangeSet"""
+        if cs.full or self.versions.get(cs.table) != cs.old_version:
+            self.index_table(cs.table, df, cs.new_version)
+            return
+        with self._lock:
+            for pos in cs.removed + cs.modified:
+                self._remove_doc((cs.table, pos))
+            changed = cs.modified + cs.added
+            for pos, text in zip(changed, self._row_texts(df, changed)):
+                self._add_doc((cs.table, pos), text)
+            self.frames[cs.table] = df
+            self.versions[cs.table] = cs.new_version
+
+    def ensure(self, name, df):
+        """Garante que o índice reflete este DataFrame (tabelas passadas fora do registro)"""
+        if self.frames.get(name) is not df:
+            self.index_table(name, df, data_registry.table_version(name))
+
+    def search(self, query, tables):
+        """[(score, tabela, posição)] em ordem decrescente de relevância"""
+        terms = set(tokenize(query))
+        with self._lock:
+            n_docs = len(self.doc_terms)
+            if not terms or not n_docs:
+                return []
+            avgdl = self.total_len / n_docs
+            scores = defaultdict(float)
+            for term in terms:
+                docs = self.postings.get(term)
+                if not docs:
+                    continue
+                idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                for doc, tf in docs.items():
+                    if doc[0] not in tables:
+                        continue
+                    dl = self.doc_len[doc]
+                    scores[doc] += idf * tf * (self.K1 + 1) / (tf + self.K1 * (1 - self.B + self.B * dl / avgdl))
+            for name in tables:
+                matched = terms & self.headers.get(name, set())
+                rows = len(self.frames[name]) if name in self.frames else 0
+                if not matched or not rows:
+                    continue
+                # Documento do cabeçalho (tf = 1): a pontuação é repartida entre as linhas
+                share = sum(math.log(1 + (n_docs - len(self.postings.get(t, ())) + 0.5)
+                                     / (len(self.postings.get(t, ())) + 0.5)) for t in matched) / rows
+                for pos in range(rows):
+                    scores[(name, pos)] += share
+        # Empates (ex.: só o cabeçalho casou) ficam na ordem das linhas
+        return sorted(((sc, t, pos) for (t, pos), sc in scores.items()), key=lambda r: (-r[0], r[1], r[2]))
+
+@st.cache_resource(show_spinner=False)
+def get_row_index():
+    index = RowIndex()
+    _, current = data_registry.current()
+    for name, df in current.items():
+        index.index_table(name, df, data_registry.table_version(name))
+    data_registry.subscribe("row_index", index.apply_change_set)
+    return index
+
+row_index = get_row_index()
+
+# Formato de serialização por tabela: "linhas" (coluna: valor | ...) ou "compacto"
+# (cabeçalho uma vez + dicionário de valores repetidos). Ex. em secrets.toml:
+# [CONTEXT_FORMATS]
+# erros = "compacto"
+CONTEXT_FORMATS = dict(st.secrets.get("CONTEXT_FORMATS", {}))
+# Peso de cada tabela na divisão do orçamento do contexto (padrão 1.0). Ex. em secrets.toml:
+# [CONTEXT_TABLE_WEIGHTS]
+# fichas = 2.0
+CONTEXT_TABLE_WEIGHTS = dict(st.secrets.get("CONTEXT_TABLE_WEIGHTS", {}))
+CONTEXT_NOTE_RESERVE = 60  # caracteres por tabela
+# Fração mínima da relevância total garantida a cada tabela com pergunta: uma tabela sem
+# nenhum termo em comum ainda entra com as primeiras linhas, em vez de sumir do contexto
+CONTEXT_MIN_SHARE = 0.1
+COMPACT_MIN_VALUE_LEN = 6  # valores menores não compensam uma referência do dicionário
+
+# Fragmentos prontos de uma tabela: cabeçalho, texto por linha, dicionário e refs usadas por linha
+TableFragments = namedtuple("TableFragments", "header rows legend row_refs")
+
+def estimate_tokens(text):
+    # Aproximação usual de ~4 caracteres por token; suficiente para comparar formatos
+    return math.ceil(len(text) / 4)
+
+def context_format(name):
+    return "compacto" if CONTEXT_FORMATS.get(name) == "compacto" else "linhas"
+
+def serialize_compact(name, df):
+    """Formato compacto: nomes de coluna uma vez e valores repetidos trocados por @n"""
+    display = widen_for_display(df)
+    missing = display.isna().to_numpy()
+    cells = [[("" if missing[i][j] else str(v).strip().replace("|", "/").replace("\n", " "))
+              for j, v in enumerate(row)]
+             for i, row in enumerate(display.itertuples(index=False, name=None))]
+    counts = Counter(v for row in cells for v in row if len(v) >= COMPACT_MIN_VALUE_LEN)
+    legend, refs = {}, {}
+    for value, count in counts.most_common():
+        ref = f"@{len(legend) + 1}"
+        # Só vale a pena se a economia nas linhas pagar a entrada no dicionário
+        if count * (len(value) - len(ref)) <= len(ref) + len(value) + 2:
+            continue
+        legend[ref] = value
+        refs[value] = ref
+    rows, row_refs = [], []
+    for row in cells:
+        encoded = [refs.get(v, v) for v in row]
+        rows.append("|".join(encoded))
+        row_refs.append({v for v in encoded if v in legend})
+    header = (f"--- {name} (compacto: colunas uma vez, valores separados por '|', @n = dicionário) ---\n"
+              f"colunas: {'|'.join(map(str, display.columns))}")
+    return TableFragments(header, rows, legend, row_refs)
+
+def assemble_table(fragments, positions):
+    """Texto de uma tabela com as linhas pedidas (e só as entradas do dicionário que elas usam)"""
+    parts = [fragments.header]
+    if fragments.legend:
+        used = set().union(*(fragments.row_refs[p] for p in positions)) if positions else set()
+        if used:
+            parts.append("dicionário: " + "; ".join(f"{r}={v}" for r, v in fragments.legend.items() if r in used))
+    parts.extend(fragments.rows[p] for p in positions)
+    return "\n".join(parts)
+
+class FragmentCache:
+    """Texto serializado de cada linha, por versão de tabela e formato.
+
+    Compartilhado entre perguntas e sessões: entre duas recargas, montar o contexto
+    só junta strings prontas. No formato "linhas" os ChangeSets do registro
+    reserializam apenas as linhas alteradas; o "compacto" depende do dicionário da
+    tabela inteira e é refeito sob demanda a cada nova versão. As listas nunca são
+    modificadas no lugar (copy-on-write).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.frames = {}  # tabela -> DataFrame serializado
+        self.versions = {}
+        self._fragments = {}  # (tabela, formato) -> TableFragments
+        self._blocks = {}  # (tabela, formato) -> texto completo da tabela
+        self.stats = {"linhas_serializadas": 0, "usos_do_cache": 0}
+
+    def _serialize(self, df, positions):
+        self.stats["linhas_serializadas"] += len(positions)
+        if not positions or len(df.columns) == 0:
+            return []
+        return [format_row_fragment(r) for r in widen_for_display(df.iloc[positions]).to_dict(orient="records")]
+
+    def _drop_derived(self, name):
+        for key in [k for k in self._blocks if k[0] == name]:
+            del self._blocks[key]
+        self._fragments.pop((name, "compacto"), None)
+
+    def set_table(self, name, df, version=None):
+        rows = self._serialize(df, list(range(len(df))))
+        with self._lock:
+            self._fragments[(name, "linhas")] = TableFragments(f"--- {name} ---", rows, {}, None)
+            self._drop_derived(name)
+            self.frames[name] = df
+            self.versions[name] = version
+
+    def apply_change_set(self, cs, df):
+        """Consumidor do DataRegistry: reserializa só as linhas do ChangeSet"""
+        current = self._fragments.get((cs.table, "linhas"))
+        if cs.full or current is None or self.versions.get(cs.table) != cs.old_version:
+            self.set_table(cs.table, df, cs.new_version)
+            return
+        rows = list(current.rows)
+        if cs.removed:
+            del rows[min(cs.removed):]
+        changed = cs.modified + cs.added
+        for pos, fragment in zip(changed, self._serialize(df, changed)):
+            if pos < len(rows):
+                rows[pos] = fragment
+            else:
+                rows.append(fragment)
+        with self._lock:
+            self._fragments[(cs.table, "linhas")] = current._replace(rows=rows)
+            self._drop_derived(cs.table)
+            self.frames[cs.table] = df
+            self.versions[cs.table] = cs.new_version
+
+    def get(self, name, df, fmt="linhas"):
+        if self.frames.get(name) is not df:
+            self.set_table(name, df, data_registry.table_version(name))
+        elif (name, fmt) in self._fragments:
+            self.stats["usos_do_cache"] += 1
+        if (name, fmt) not in self._fragments:
+            fragments = serialize_compact(name, df)
+            self.stats["linhas_serializadas"] += len(df)
+            with self._lock:
+                self._fragments[(name, fmt)] = fragments
+        return self._fragments[(name, fmt)]
+
+    def block(self, name, df, fmt="linhas"):
+        fragments = self.get(name, df, fmt)
+        with self._lock:
+            if (name, fmt) not in self._blocks:
+                self._blocks[(name, fmt)] = assemble_table(fragments, list(range(len(fragments.rows))))
+            return self._blocks[(name, fmt)]
+
+@st.cache_resource(show_spinner=False)
+def get_fragment_cache():
+    cache = FragmentCache()
+    _, current = data_registry.current()
+    for name, df in current.items():
+        cache.set_table(name, df, data_registry.table_version(name))
+    data_registry.subscribe("fragment_cache", cache.apply_change_set)
+    return cache
+
+fragment_cache = get_fragment_cache()
+
+def allocate_budget(max_chars, demands, weights):
+    """Divide max_chars entre as tabelas proporcionalmente ao peso.
+
+    Tabelas que precisam de menos que a sua parte recebem só o necessário e a sobra
+    é redistribuída entre as demais (water-filling).
+    """
+    alloc = {name: 0.0 for name in demands}
+    active = {name for name, demand in demands.items() if demand > 0 and weights.get(name, 0) > 0}
+    remaining = float(max_chars)
+    while active and remaining > 0:
+        total_weight = sum(weights[n] for n in active)
+        share = {n: remaining * weights[n] / total_weight for n in active}
+        satisfied = {n for n in active if demands[n] - alloc[n] <= share[n]}
+        if not satisfied:
+            for n in active:
+                alloc[n] += share[n]
+            break
+        for n in satisfied:
+            remaining -= demands[n] - alloc[n]
+            alloc[n] = demands[n]
+        active -= satisfied
+    return {name: int(v) for name, v in alloc.items()}
+
+def table_weight(name):
+    return float(CONTEXT_TABLE_WEIGHTS.get(name, 1.0))
+
+def fill_budget(fragments, candidates, weights, max_chars):
+    """Escolhe as linhas de cada tabela dentro da sua parte do orçamento, sem cortar linha no meio.
+
+    `candidates` traz as posições de cada tabela em ordem de preferência. Depois da
+    divisão por peso, o que sobrou é oferecido de novo às tabelas de maior peso.
+    """
+    def demand(name):
+        tf = fragments[name]
+        legend = sum(len(r) + len(v) + 3 for r, v in tf.legend.items())
+        return len(tf.header) + 1 + legend + sum(len(tf.rows[p]) + 1 for p in candidates[name])
+
+    alloc = allocate_budget(max_chars, {n: demand(n) for n in candidates}, weights)
+    selected = {n: [] for n in candidates}
+    chosen = {n: set() for n in candidates}
+    used_refs = {n: set() for n in candidates}
+    spent = {n: 0 for n in candidates}
+
+    def take(name, limit):
+        tf = fragments[name]
+        for pos in candidates[name]:
+            if pos in chosen[name]:
+                continue
+            new_refs = (tf.row_refs[pos] - used_refs[name]) if tf.legend else set()
+            cost = (len(tf.rows[pos]) + 1 + sum(len(r) + len(tf.legend[r]) + 3 for r in new_refs)
+                    + (0 if selected[name] else len(tf.header) + 1)
+                    + (13 if new_refs and not used_refs[name] else 0))
+            if spent[name] + cost > limit:
+                continue
+            selected[name].append(pos)
+            chosen[name].add(pos)
+            used_refs[name] |= new_refs
+            spent[name] += cost
+
+    for name in candidates:
+        take(name, alloc[name])
+    for name in sorted(candidates, key=lambda n: weights.get(n, 0), reverse=True):
+        leftover = max_chars - sum(spent.values())
+        if leftover <= 0:
+            break
+        take(name, spent[name] + leftover)
+    return selected, alloc
+
+def build_context(dfs, max_chars=30000, prompt=None, report=None):
+    """Contexto para o Gemini, com orçamento dividido entre as tabelas.
+
+    Com pergunta, as linhas candidatas de cada tabela são as relevantes (BM25) em
+    ordem de relevância e o peso da tabela é CONTEXT_TABLE_WEIGHTS × a sua fração
+    da relevância (no mínimo CONTEXT_MIN_SHARE); uma tabela sem linhas relevantes
+    entra com as linhas em ordem. Sem pergunta, ou sem nenhum termo em comum com os
+    dados, todas as linhas em ordem, com os pesos configurados. Nenhuma tabela é
+    cortada no meio de uma linha e o que ficou de fora (inclusive tabelas inteiras)
+    é anotado no próprio contexto e em `report` (formato, linhas incluídas/omitidas,
+    caracteres, tokens por tabela).
+    """
+    dfs = {name: df for name, df in dfs.items() if not df.empty}
+    if not dfs:
+        return ""
+    fragments = {name: fragment_cache.get(name, df, context_format(name)) for name, df in dfs.items()}
+    ranked = []
+    if prompt:
+        for name, df in dfs.items():
+            row_index.ensure(name, df)
+        ranked = row_index.search(prompt, set(dfs))
+
+    if ranked:
+        candidates, relevance = {name: [] for name in dfs}, defaultdict(float)
+        for score, name, pos in ranked:
+            candidates[name].append(pos)
+            relevance[name] += score
+        total = sum(relevance.values())
+        for name, df in dfs.items():
+            if not candidates[name]:
+                candidates[name] = list(range(len(df)))
+        weights = {name: table_weight(name) * max(relevance[name] / total, CONTEXT_MIN_SHARE) for name in dfs}
+    else:
+        candidates = {name: list(range(len(df))) for name, df in dfs.items()}
+        weights = {name: table_weight(name) for name in dfs}
+
+    # Reserva para as quebras entre tabelas e a nota de linhas omitidas
+    selected, alloc = fill_budget(fragments, candidates, weights, max_chars - CONTEXT_NOTE_RESERVE * len(dfs))
+    parts, omitted_notes = [], []
+    for name in dfs:
+        positions = sorted(selected[name])
+        omitted = len(candidates[name]) - len(positions)
+        text = assemble_table(fragments[name], positions) if positions else ""
+        if text:
+            parts.append(text)
+        if not positions:
+            omitted = len(dfs[name])
+            omitted_notes.append(f"{name}: tabela omitida ({omitted} linhas)")
+        elif omitted:
+            kind = "relevantes " if ranked and relevance[name] else ""
+            omitted_notes.append(f"{name}: {len(positions)} de {len(candidates[name])} linhas {kind}incluídas")
+        if report is not None:
+            report[name] = {"formato": context_format(name), "orcamento": alloc.get(name, 0),
+                            "linhas": len(positions), "linhas_omitidas": omitted, "omitida": not positions,
+                            "caracteres": len(text), "tokens_est": estimate_tokens(text)}
+    if omitted_notes:
+        parts.append("[CONTEXTO LIMITADO — " + "; ".join(omitted_notes) + "]")
+    return "\n".join(parts)
+
+@st.cache_resource(show_spinner=False)
+def get_llm_latency_stats():
+    """Latências (s) das chamadas ao Gemini, por combinação de formatos de contexto"""
+    return defaultdict(list)
+
+def benchmark_context_formats(dfs, max_chars=30000):
+    """Compara os formatos por tabela: linhas que cabem no orçamento, caracteres e tokens por linha"""
+    rows = []
     for name, df in dfs.items():
         if df.empty:
             continue
-        parts.append(f"--- {name} ---")
-        for r in df.to_dict(orient="records"):
-            row_items = [f"{k}: {v}" for k,v in r.items() if v is not None and str(v).strip() != '']
-            parts.append(" | ".join(row_items))
-    context = "\n".join(parts)
-    if len(context) > max_chars:
-        context = context[:max_chars] + "\n...[CONTEXTO TRUNCADO]"
-    return context
+        for fmt in ("linhas", "compacto"):
+            t0 = time.perf_counter()
+            tf = fragment_cache.get(name, df, fmt)
+            block = fragment_cache.block(name, df, fmt)
+            # Custo fixo da tabela: cabeçalho e dicionário completo
+            fit, size = 0, len(block) - sum(len(r) + 1 for r in tf.rows)
+            for row in tf.rows:
+                size += len(row) + 1
+                if size > max_chars:
+                    break
+                fit += 1
+            rows.append({"tabela": name, "formato": fmt, "linhas_no_orcamento": fit, "linhas_total": len(df),
+                         "tokens_est_tabela": estimate_tokens(block),
+                         "tokens_por_linha": round(estimate_tokens(block) / max(len(df), 1), 1),
+                         "ms": round((time.perf_counter() - t0) * 1000, 1)})
+    return pd.DataFrame(rows)
+
+# Ferramentas de consulta expostas ao modelo (function calling)
+TOOL_MAX_ROWS = 20
+DATA_TOOL_DECLARATIONS = [
+    {"name": "search_fichas",
+     "description": "Busca fichas técnicas por texto livre (referência, produto, decoração, observações).",
+     "parameters": {"type": "OBJECT", "properties": {
+         "texto": {"type": "STRING", "description": "Termos de busca"},
+         "limite": {"type": "INTEGER", "description": "Máximo de fichas (padrão 10)"}},
+         "required": ["texto"]}},
+    {"name": "get_reference_parameters",
+     "description": "Todos os parâmetros de impressão e consumos de tinta de uma referência.",
+     "parameters": {"type": "OBJECT", "properties": {
+         "referencia": {"type": "STRING", "description": "Código da referência, ex: 17683"}},
+         "required": ["referencia"]}},
+    {"name": "aggregate_oee",
+     "description": "Médias de OEE/TEEP, disponibilidade, performance e qualidade por planilha, "
+                    "filtrando por máquina e período (datas AAAA-MM-DD).",
+     "parameters": {"type": "OBJECT", "properties": {
+         "maquina": {"type": "STRING", "description": "Máquina (parte do nome); vazio = todas"},
+         "inicio": {"type": "STRING", "description": "Data inicial AAAA-MM-DD"},
+         "fim": {"type": "STRING", "description": "Data final AAAA-MM-DD"}}}},
+    {"name": "list_errors_by_code",
+     "description": "Lista os registros da planilha de erros com um código (ou texto) de erro.",
+     "parameters": {"type": "OBJECT", "properties": {
+         "codigo": {"type": "STRING", "description": "Código ou trecho da descrição do erro"},
+         "limite": {"type": "INTEGER", "description": "Máximo de linhas (padrão 20)"}},
+         "required": ["codigo"]}},
+]
+OEE_METRIC_FRAGMENTS = ("oee", "teep", "disponib", "perform", "qualidade")
+
+def find_columns(df, *fragments):
+    """Colunas cujo nome normalizado contém algum dos trechos"""
+    return [c for c in df.columns if any(f in normalize_text(c) for f in fragments)]
+
+def to_number(s):
+    """Números das planilhas ("85,3%", "0.9") como float"""
+    if pd.api.types.is_numeric_dtype(s):
+        return s.astype(float)
+    text = s.astype(str).str.strip().str.rstrip("%").str.replace(",", ".", regex=False)
+    return pd.to_numeric(text, errors="coerce")
+
+def records(df, limit=TOOL_MAX_ROWS):
+    return json.loads(widen_for_display(df.head(limit)).to_json(orient="records", force_ascii=False,
+                                                                date_format="iso"))
+
+class DataTools:
+    """Consultas locais que o modelo chama em vez de receber as tabelas no prompt.
+
+    Rodam sobre as tabelas desta pergunta e o SQLite das fichas (índices FTS5 e
+    de referência) e devolvem no máximo TOOL_MAX_ROWS linhas, então o prompt cresce
+    só com o que o modelo pediu. `trace` guarda cada chamada para o diagnóstico.
+    """
+
+    def __init__(self, dfs):
+        self.dfs = dfs
+        self.trace = []
+
+    def catalog(self):
+        """Resumo das tabelas para as instruções de sistema (sem as linhas)"""
+        lines = ["Os dados NÃO estão neste contexto: consulte-os com as ferramentas disponíveis.",
+                 "Tabelas carregadas:"]
+        for name, df in self.dfs.items():
+            if not df.empty:
+                lines.append(f"- {name}: {len(df)} linhas; colunas: {', '.join(map(str, df.columns))}")
+        return "\n".join(lines)
+
+    def call(self, name, args):
+        t0 = time.perf_counter()
+        method = getattr(self, name, None) if name in {d["name"] for d in DATA_TOOL_DECLARATIONS} else None
+        try:
+            result = method(**args) if method else {"erro": f"ferramenta desconhecida: {name}"}
+        except Exception as e:
+            result = {"erro": str(e)}
+        self.trace.append({"ferramenta": name, "argumentos": json.dumps(args, ensure_ascii=False),
+                           "linhas": len(result) if isinstance(result, list) else 1,
+                           "caracteres": len(json.dumps(result, ensure_ascii=False, default=str)),
+                           "ms": round((time.perf_counter() - t0) * 1000, 1)})
+        return result
+
+    def search_fichas(self, texto, limite=10):
+        fichas = self.dfs.get("fichas", pd.DataFrame())
+        if fichas.empty:
+            return []
+        return records(search_fichas_fts(texto, int(limite)).drop(columns="rank"), int(limite))
+
+    def get_reference_parameters(self, referencia):
+        fichas = self.dfs.get("fichas", pd.DataFrame())
+        if fichas.empty:
+            return []
+        return records(lookup_references([referencia]).drop(columns=["id", "image_path"], errors="ignore"))
+
+    def aggregate_oee(self, maquina="", inicio="", fim=""):
+        result = {}
+        for name, df in self.dfs.items():
+            metrics = find_columns(df, *OEE_METRIC_FRAGMENTS)
+            if df.empty or not metrics:
+                continue
+            mask = pd.Series(True, index=df.index)
+            machine_cols = find_columns(df, "maquina")
+            if maquina and machine_cols:
+                mask &= df[machine_cols[0]].astype(str).map(normalize_text).str.contains(
+                    normalize_text(maquina), regex=False)
+            date_cols = find_columns(df, "data")
+            dates = pd.to_datetime(df[date_cols[0]], dayfirst=True, errors="coerce") if date_cols else None
+            if dates is not None and inicio:
+                mask &= dates >= pd.Timestamp(inicio)
+            if dates is not None and fim:
+                mask &= dates <= pd.Timestamp(fim)
+            subset = df[mask]
+            means = {c: round(float(v), 3) for c in metrics if pd.notna(v := to_number(subset[c]).mean())}
+            entry = {"linhas": int(len(subset)), "medias": means}
+            if dates is not None and mask.any():
+                entry["periodo"] = [str(dates[mask].min().date()), str(dates[mask].max().date())]
+            result[name] = entry
+        return result
+
+    def list_errors_by_code(self, codigo, limite=20):
+        erros = self.dfs.get("erros", pd.DataFrame())
+        if erros.empty:
+            return []
+        needle = normalize_text(codigo)
+        cols = find_columns(erros, "codigo", "cod", "erro") or list(erros.columns)
+        mask = pd.Series(False, index=erros.index)
+        for c in cols:
+            mask |= erros[c].astype(str).map(normalize_text).str.contains(needle, regex=False)
+        return records(erros[mask], int(limite))
 
 @st.cache_data
 def load_drive_media(url):
@@ -921,7 +3222,14 @@ def load_drive_media(url):
         if not file_id: return None
         
         direct_url = f"https://drive.google.com/uc?export=download&id={file_id}"
-        res = requests.get(direct_url, timeout=10)
+
+        def download():
+            res = requests.get(direct_url, timeout=10)
+            if res.status_code == 429:
+                res.raise_for_status()  # deixa o limitador aplicar o backoff
+            return res
+
+        res = google_limiter.call(download, key=f"media:{file_id}")
         if res.status_code == 200:
             return res.content
     except:
@@ -945,8 +3253,12 @@ def get_media_type(url):
         
     return 'unknown'
 
-def render_smart_response(text):
-    """Renderiza texto e mídia de forma intercalada, detectando links de forma robusta"""
+def render_smart_response(text, strip_bullets=True):
+    """Renderiza texto e mídia de forma intercalada, detectando links de forma robusta.
+
+    strip_bullets remove o marcador de lista no início de cada trecho de texto; o
+    StreamRenderer só o liga no primeiro bloco, o começo da resposta.
+    """
     # Procura por "Link de X: URL" ou apenas URLs de mídia soltas
     pattern = r'((?:Link de [A-Za-zãõí\s]+:?\s*)?https?://[^\s\)\n]+)'
     
@@ -1002,14 +3314,133 @@ def render_smart_response(text):
         else:
             clean_part = part.strip()
             if clean_part:
-                clean_part = re.sub(r'^[\s\n]*[\*\-]\s*', '', clean_part)
+                if strip_bullets:
+                    clean_part = re.sub(r'^[\s\n]*[\*\-]\s*', '', clean_part)
                 if clean_part:
                     st.markdown(process_response(clean_part))
 
 
+# URL ainda sendo escrita no fim do texto: só vira mídia quando vier o espaço seguinte
+PENDING_URL = re.compile(r'(?:Link de [A-Za-zãõí\s]+:?\s*)?https?://\S*$', re.IGNORECASE)
+
+class StreamRenderer:
+    """Desenha a resposta conforme os pedaços do stream chegam.
+
+    Blocos fechados (separados por linha em branco, fora de tabela) passam por
+    render_smart_response e ficam fixos; o trecho em aberto aparece como markdown
+    simples num placeholder. Um link sem espaço depois dele é segurado até
+    estar completo, para a mídia só ser resolvida com a URL inteira.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.text = ""
+        self.live = None
+        self.blocks = 0
+
+    def feed(self, chunk):
+        if not chunk:
+            return
+        self.text += chunk
+        self.buffer += chunk
+        while True:
+            cut = self._block_end()
+            if cut < 0:
+                break
+            block, self.buffer = self.buffer[:cut], self.buffer[cut + 2:]
+            self._commit(block)
+        self._show_live()
+
+    def _block_end(self):
+        """Primeira linha em branco fora de bloco de código (nº par de ``` antes dela), ou -1"""
+        pos = self.buffer.find("\n\n")
+        while pos >= 0 and self.buffer.count("```", 0, pos) % 2:
+            pos = self.buffer.find("\n\n", pos + 1)
+        return pos
+
+    def close(self):
+        if self.buffer.strip():
+            self._commit(self.buffer)
+        elif self.live is not None:
+            self.live.empty()
+        self.buffer = ""
+
+    def _commit(self, block):
+        if self.live is not None:
+            self.live.empty()
+            self.live = None
+        # Limpeza mínima: apenas links de imagem redundantes se houver
+        block = re.sub(r'Links de imagens:?', '', block, flags=re.IGNORECASE)
+        if block.strip():
+            # Blocos seguintes começam com listas e negrito de verdade: não tira o marcador
+            render_smart_response(block, strip_bullets=self.blocks == 0)
+            self.blocks += 1
+
+    def _show_live(self):
+        visible = PENDING_URL.sub("", self.buffer).strip()
+        if not visible:
+            return
+        if self.live is None:
+            self.live = st.empty()
+        self.live.markdown(process_response(visible) + " ▌")
+
 def remove_drive_links(text):
     return re.sub(r'https?://drive\.google\.com/file/d/[a-zA-Z0-9_-]+/view\?usp=drive_link', '', text)
 
+with st.sidebar.expander("Diagnóstico de desempenho"):
+    last_run = st.session_state.get("last_script_time")
+    if last_run is not None:
+        st.write(f"Última execução do script: {last_run * 1000:.0f} ms")
+    if st.session_state.get("load_timings"):
+        st.write("Último carregamento das planilhas:")
+        st.dataframe(pd.DataFrame.from_dict(st.session_state.load_timings, orient="index"))
+    st.write("Cache das planilhas:", sheet_cache.stats)
+    st.write("Cache de fragmentos do contexto:", fragment_cache.stats)
+    st.write(f"Chamadas Google (taxa atual {google_limiter.rate:.2f}/s):", google_limiter.stats)
+    st.write("Retentativas do Gemini:", gemini_retries.stats)
+    st.write(f"Cache de respostas ({len(answer_cache)} guardadas):", answer_cache.stats)
+    st.write("Consultas diretas às fichas:", get_router_stats())
+    if context_cache is not None:
+        st.write(f"Contexto em cache ({CONTEXT_CACHE_MODE}):", context_cache.stats)
+    if data_registry.last_changes:
+        st.write("Últimas mudanças por tabela:")
+        st.dataframe(pd.DataFrame.from_dict(data_registry.last_changes, orient="index"))
+    if get_schema_reports():
+        st.write("Memória por tabela (antes/depois da tipagem):")
+        st.dataframe(pd.DataFrame.from_dict(get_schema_reports(), orient="index"))
+    lazy_times = get_lazy_import_times()
+    if lazy_times:
+        st.write("Imports sob demanda já carregados neste processo:")
+        st.dataframe(pd.DataFrame(
+            [{"modulo": k, "ms": round(v * 1000, 1)} for k, v in lazy_times.items()]
+        ), hide_index=True)
+    if st.session_state.get("last_llm_timing"):
+        st.write("Última resposta do Gemini:", st.session_state.last_llm_timing)
+    if st.session_state.get("last_image_report"):
+        st.write("Última imagem enviada (original → enviada):", st.session_state.last_image_report)
+    if st.session_state.get("last_tool_calls"):
+        st.write("Ferramentas chamadas na última pergunta:")
+        st.dataframe(pd.DataFrame(st.session_state.last_tool_calls), hide_index=True)
+    if st.session_state.get("last_context_report"):
+        st.write("Contexto da última pergunta:")
+        st.dataframe(pd.DataFrame.from_dict(st.session_state.last_context_report, orient="index"))
+    if st.button("Comparar formatos de contexto"):
+        st.dataframe(benchmark_context_formats(dict(tables)), hide_index=True)
+        latencies = get_llm_latency_stats()
+        if latencies:
+            st.write("Latência do Gemini por formato:")
+            st.dataframe(pd.DataFrame([{"formatos": k, "chamadas": len(v), "media_s": round(sum(v) / len(v), 2)}
+                                       for k, v in latencies.items()]), hide_index=True)
+    st.write("Conexões SQLite:", sqlite_pool.stats)
+    if st.button("Medir consultas SQLite"):
+        st.dataframe(benchmark_sqlite_lookups(), hide_index=True)
+    if st.button("Medir tempo de importação"):
+        with st.spinner("Medindo imports em processos limpos..."):
+            bench = run_import_benchmark(tuple(HEAVY_MODULES))
+        deferred = bench.loc[bench["sob_demanda"], "cumulativo_ms"].fillna(0).sum()
+        st.write(f"Custo evitado no carregamento inicial: ~{deferred:.0f} ms (soma, há dependências compartilhadas)")
+        st.dataframe(bench, hide_index=True)
+
 col_esq, col_meio, col_dir = st.columns([1,3,1])
 with col_meio:
     st.markdown("<h1 class='custom-font'>PlasPrint IA</h1><br>", unsafe_allow_html=True)
@@ -1018,12 +3449,45 @@ with col_dir:
     pass  # Coluna direita vazia
 
 
+@st.fragment(run_every=2)
+def show_pending_answer():
+    # Resposta adiada por cota: confere o worker sem bloquear o resto da página
+    pending = st.session_state.get("pending_chat")
+    if not pending:
+        return
+    future = pending["future"]
+    if not future.done():
+        st.info(f"Aguardando cota do Gemini para \"{pending['prompt']}\" "
+                f"({time.time() - pending['since']:.0f}s)...")
+        return
+    del st.session_state.pending_chat
+    try:
+        text = future.result()
+        st.session_state.chat_result = {"prompt": pending["prompt"], "text": text}
+        if text.strip() and "cache_key" in pending:
+            answer_cache.put(pending["cache_key"], pending["prompt"], text, pending["versions"])
+    except Exception as e:
+        st.session_state.chat_result = {"prompt": pending["prompt"], "error": str(e)}
+    st.rerun()
+
 with col_meio:
 
 
 
 
 
+    chat_result = st.session_state.pop("chat_result", None)
+    if chat_result:
+        with st.chat_message("user"):
+            st.markdown(chat_result["prompt"])
+        with st.chat_message("assistant"):
+            if "error" in chat_result:
+                st.error(f"Erro ao processar: {chat_result['error']}")
+            else:
+                renderer = StreamRenderer()
+                renderer.feed(chat_result["text"])
+                renderer.close()
+
     if True: # Removida navegação, mantendo apenas Assistente
         # Input do chat
         prompt = st.chat_input("Qual a sua dúvida?")
@@ -1037,22 +3501,28 @@ with col_meio:
                 st.markdown(prompt)
                 image_to_send = None
                 if uploaded_file:
-                    image_to_send = PIL.Image.open(uploaded_file)
-                    st.image(image_to_send, caption="Imagem enviada", use_container_width=True)
+                    image_to_send = prepare_image(uploaded_file.getvalue())
+                    st.session_state.last_image_report = image_to_send["report"]
+                    st.image(image_to_send["data"], caption="Imagem enviada", use_container_width=True)
 
             # Processar resposta
             with st.chat_message("assistant"):
                 dfs = {
-                    "erros": st.session_state.erros_df,
+                    "erros": tables.get("erros", pd.DataFrame()),
                     "trabalhos": pd.DataFrame(),
-                    "dacen": st.session_state.dacen_df,
-                    "psi": st.session_state.psi_df,
-                    "gerais": st.session_state.gerais_df
+                    "dacen": tables.get("dacen", pd.DataFrame()),
+                    "psi": tables.get("psi", pd.DataFrame()),
+                    "gerais": tables.get("gerais", pd.DataFrame()),
+                    "fichas": tables.get("fichas", pd.DataFrame())
                 }
                 
 
                 process_chat_request(prompt, dfs, image_to_send)
 
+        # Depois do pedido atual, para acompanhar também o que acabou de ser adiado
+        if st.session_state.get("pending_chat"):
+            show_pending_answer()
+
 
 
 
@@ -1076,6 +3546,7 @@ footer_html = f"""
 """
 
 st.markdown(footer_css + footer_html, unsafe_allow_html=True)
+st.session_state.last_script_time = time.perf_counter() - _SCRIPT_T0
 print(">>> Script finalizado e pronto para exibir na tela.")
 
 
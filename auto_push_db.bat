@@ -11,12 +11,14 @@ REM Caminho de destino dentro do repo
 set DST_DB="D:\IMPRESSAO\SOFTWARES\PlasPrint IA v2.0\PlasPrint2.0\fichas_tecnicas.db"
 
 REM ===== COPIAR O ARQUIVO =====
-copy %SRC_DB% %DST_DB% /Y
+REM Copia para temporario, confere integridade e hash e so entao troca o arquivo
+python sync_db.py %SRC_DB% %DST_DB%
+if errorlevel 1 goto end
 
 REM ===== ATUALIZAR REPO (pull + commit + push) =====
 git pull origin main
 
-git add fichas_tecnicas.db
+git add fichas_tecnicas.db fichas_tecnicas.db.version
 
 git commit -m "Atualização automática do fichas_tecnicas.db" || goto end
 
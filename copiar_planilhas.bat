@@ -50,8 +50,7 @@ if exist "%ORIGEM%\rejeito.xlsx" (
 echo.
 echo Copiando fichas_tecnicas.db de %ORIGEM_DB% para %DESTINO%...
 if exist "%ORIGEM_DB%\fichas_tecnicas.db" (
-    copy "%ORIGEM_DB%\fichas_tecnicas.db" "%DESTINO%\fichas_tecnicas.db" /Y
-    echo ✓ fichas_tecnicas.db copiado com sucesso
+    python "%~dp0sync_db.py" "%ORIGEM_DB%\fichas_tecnicas.db" "%DESTINO%\fichas_tecnicas.db"
 ) else (
     echo ⚠ Arquivo fichas_tecnicas.db não encontrado em %ORIGEM_DB%
 )
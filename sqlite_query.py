@@ -0,0 +1,74 @@
+"""Montagem do SELECT do query_sqlite: projeção, filtros, ordem e paginação por chave.
+
+Fica fora do app.py para poder ser testado sem Streamlit; o app executa a consulta
+(pelo pool de conexões, com cache por versão do arquivo) e chama split_page.
+"""
+
+QUERY_OPERATORS = {"=", "<>", "<", "<=", ">", ">=", "LIKE", "IN"}
+
+
+def build_select(table, known, columns=None, where=(), order_by=(), after=None, limit=50):
+    """(sql, params, colunas de chave) para uma página da consulta.
+
+    known: colunas da tabela (PRAGMA table_info); nomes fora dela são recusados.
+    where: (coluna, operador, valor), operador em QUERY_OPERATORS ("IN" recebe uma sequência)
+    order_by: (coluna, "ASC"/"DESC"); NULL fica por último nas duas direções e
+    rowid entra no fim como desempate
+    after: cursor devolvido por split_page na página anterior
+
+    O SELECT pede limit + 1 linhas: a sobra indica que há próxima página.
+    """
+    def ident(col):
+        if col not in known:
+            raise ValueError(f"Coluna desconhecida em {table}: {col}")
+        return f'"{col}"'
+
+    select = [ident(c) for c in (columns or known)]
+    clauses, params = [], []
+    for col, op, value in where:
+        op = op.upper()
+        if op not in QUERY_OPERATORS:
+            raise ValueError(f"Operador não suportado: {op}")
+        if op == "IN":
+            value = list(value)
+            clauses.append(f"{ident(col)} IN ({', '.join('?' * len(value))})")
+            params += value
+        else:
+            clauses.append(f"{ident(col)} {op} ?")
+            params.append(value)
+
+    order = []
+    for col, direction in order_by:
+        if direction.upper() not in ("ASC", "DESC"):
+            raise ValueError(f"Direção inválida: {direction}")
+        # Comparações com NULL nunca são verdadeiras; a chave "é nulo" (0/1, nunca NULL)
+        # separa as linhas nulas e o cursor passa por elas sem pular nenhuma
+        order.append((f"({ident(col)} IS NULL)", "ASC"))
+        order.append((ident(col), direction.upper()))
+    order.append(("rowid", "ASC"))
+    if after is not None:
+        # Linhas depois do cursor: (k1 > v1) OR (k1 IS v1 AND k2 > v2) ..., respeitando a direção
+        alternatives = []
+        for i, (col, direction) in enumerate(order):
+            eqs = [f"{c} IS ?" for c, _ in order[:i]]
+            alternatives.append("(" + " AND ".join(eqs + [f"{col} {'>' if direction == 'ASC' else '<'} ?"]) + ")")
+            params += list(after[:i + 1])
+        clauses.append("(" + " OR ".join(alternatives) + ")")
+
+    keys = ", ".join(f"{col} AS _k{i}" for i, (col, _) in enumerate(order))
+    sql = f'SELECT {keys}, {", ".join(select)} FROM "{table}"'
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += " ORDER BY " + ", ".join(f"{col} {direction}" for col, direction in order) + " LIMIT ?"
+    params.append(int(limit) + 1)
+    return sql, params, [f"_k{i}" for i in range(len(order))]
+
+
+def split_page(df, key_cols, limit):
+    """(página sem as colunas de chave, cursor da próxima página ou None)"""
+    cursor = None
+    if len(df) > limit:
+        df = df.head(limit)
+        cursor = tuple(None if v != v else v.item() if hasattr(v, "item") else v
+                       for v in df.iloc[-1][key_cols])
+    return df.drop(columns=key_cols).reset_index(drop=True), cursor
@@ -0,0 +1,175 @@
+"""Sincroniza o fichas_tecnicas.db da rede com a cópia local sem expor arquivo pela metade.
+
+Uso: python sync_db.py [origem] [destino]
+
+1. Se tamanho e data da origem batem com a última sincronização, não faz nada.
+2. Com uma trava de leitura na origem, calcula o sha256; se o conteúdo é o mesmo
+   da última vez, só atualiza o registro e termina.
+3. Copia pela API de backup do SQLite para um arquivo temporário na pasta de
+   destino e confere PRAGMA integrity_check e a presença da tabela fichas.
+4. Cria `<destino>.swap`: o app fecha as conexões livres em ~1 s e passa a fechar
+   as demais ao fim de cada consulta. Troca o arquivo de uma vez com os.replace
+   (com novas tentativas enquanto o Windows acusar o arquivo em uso), grava
+   `<destino>.version`, que o app lê para recarregar só o que vem do banco, e
+   remove o `.swap`.
+"""
+import hashlib
+import json
+import os
+import pathlib
+import sqlite3
+import sys
+import tempfile
+import time
+import datetime
+
+ORIGEM_PADRAO = r"Y:\_ARQUIVOS\PlasPrint Fichas\fichas_tecnicas.db"
+DESTINO_PADRAO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fichas_tecnicas.db")
+REPLACE_TENTATIVAS = 6
+REPLACE_ESPERA = 0.5  # s, dobra a cada tentativa (até ~30 s no total)
+SWAP_AVISO = 2.0  # s entre criar o .swap e a troca (o app confere a cada 1 s)
+
+
+def version_path(destino):
+    return destino + ".version"
+
+
+def swap_path(destino):
+    return destino + ".swap"
+
+
+def read_version(destino):
+    try:
+        with open(version_path(destino), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_version(destino, info):
+    """Grava o registro da sincronização também de forma atômica"""
+    tmp = version_path(destino) + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=1)
+    os.replace(tmp, version_path(destino))
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def check_copy(path):
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        if result != "ok":
+            raise RuntimeError(f"integrity_check falhou: {result}")
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'fichas'").fetchone():
+            raise RuntimeError("a cópia não tem a tabela fichas")
+        # A cópia entra em modo rollback, o mesmo que o app usa (sem -wal ao lado do arquivo)
+        conn.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        conn.close()
+
+
+def replace_with_retry(tmp, destino):
+    espera = REPLACE_ESPERA
+    for tentativa in range(REPLACE_TENTATIVAS):
+        try:
+            os.replace(tmp, destino)
+            return
+        except PermissionError:
+            # Windows: alguma consulta do app ainda está com o arquivo aberto; as conexões
+            # livres já foram fechadas pelo .swap e as emprestadas fecham ao terminar
+            if tentativa == REPLACE_TENTATIVAS - 1:
+                raise
+            print(f"  arquivo em uso, nova tentativa em {espera:.1f}s...")
+            time.sleep(espera)
+            espera *= 2
+
+
+def checkpoint_destino(destino):
+    """Esvazia o WAL do arquivo atual para que ele não seja reaplicado sobre o novo"""
+    if not os.path.exists(destino):
+        return
+    conn = sqlite3.connect(destino)
+    try:
+        busy, _, _ = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    finally:
+        conn.close()
+    if busy:
+        # Um WAL não aplicado seria perdido (ou aplicado sobre o arquivo novo): não troca
+        raise RuntimeError("checkpoint do destino não concluído (banco em uso); tente de novo")
+
+
+def sync(origem, destino):
+    """Devolve "inalterado" ou "atualizado"; em erro o destino fica como estava"""
+    info = read_version(destino)
+    stat = os.stat(origem)
+    if (os.path.exists(destino) and info.get("origem_tamanho") == stat.st_size
+            and info.get("origem_mtime_ns") == stat.st_mtime_ns):
+        return "inalterado"
+
+    uri = pathlib.Path(origem).absolute().as_uri() + "?mode=ro"
+    src = sqlite3.connect(uri, uri=True)
+    tmp = None
+    try:
+        # Trava de leitura: ninguém grava na origem enquanto o hash e a cópia são feitos
+        src.execute("BEGIN")
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        digest = file_sha256(origem)
+        info.update(origem_tamanho=stat.st_size, origem_mtime_ns=stat.st_mtime_ns)
+        if os.path.exists(destino) and info.get("sha256") == digest:
+            write_version(destino, info)
+            return "inalterado"
+
+        fd, tmp = tempfile.mkstemp(prefix=".fichas_", suffix=".tmp", dir=os.path.dirname(os.path.abspath(destino)))
+        os.close(fd)
+        dst = sqlite3.connect(tmp)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+        src.rollback()
+        check_copy(tmp)
+
+        with open(swap_path(destino), "w", encoding="utf-8"):
+            pass
+        try:
+            time.sleep(SWAP_AVISO)
+            checkpoint_destino(destino)
+            replace_with_retry(tmp, destino)
+            tmp = None
+            info.update(sha256=digest, version=int(info.get("version", 0)) + 1,
+                        sincronizado_em=datetime.datetime.now().isoformat(timespec="seconds"))
+            write_version(destino, info)
+        finally:
+            os.remove(swap_path(destino))
+        return "atualizado"
+    finally:
+        src.close()
+        if tmp and os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def main(argv):
+    origem = argv[1] if len(argv) > 1 else ORIGEM_PADRAO
+    destino = argv[2] if len(argv) > 2 else DESTINO_PADRAO
+    try:
+        status = sync(origem, destino)
+    except Exception as e:
+        print(f"⚠ Falha ao sincronizar {origem}: {e}")
+        return 1
+    if status == "inalterado":
+        print("✓ fichas_tecnicas.db sem alterações, nada a copiar")
+    else:
+        print(f"✓ fichas_tecnicas.db atualizado (versão {read_version(destino).get('version')})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,84 @@
+"""Paginação por chave do query_sqlite sobre um SQLite em memória: python -m unittest discover tests"""
+import os
+import sqlite3
+import sys
+import unittest
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlite_query import build_select, split_page  # noqa: E402
+
+COLUMNS = ["id", "referencia", "produto", "decoracao", "tempo_s"]
+
+
+def make_db():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE fichas (id INTEGER PRIMARY KEY, referencia TEXT, produto TEXT, decoracao TEXT, tempo_s REAL)")
+    rows = []
+    for i in range(52):
+        # Um terço das decorações e alguns tempos ficam NULL, com valores repetidos no resto
+        decoracao = None if i % 3 == 0 else f"dec{i % 5}"
+        tempo = None if i % 7 == 0 else float(i % 4)
+        rows.append((i + 1, str(10000 + i), f"prod{i % 6}", decoracao, tempo))
+    conn.executemany("INSERT INTO fichas VALUES (?, ?, ?, ?, ?)", rows)
+    return conn
+
+
+def fetch_all(conn, page_size, **query):
+    pages, cursor = [], None
+    while True:
+        sql, params, key_cols = build_select("fichas", COLUMNS, after=cursor, limit=page_size, **query)
+        df, cursor = split_page(pd.read_sql_query(sql, conn, params=params), key_cols, page_size)
+        pages.append(df)
+        if cursor is None:
+            return pd.concat(pages, ignore_index=True)
+
+
+class KeysetPaginationTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = make_db()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_nullable_sort_column_returns_every_row(self):
+        for direction in ("ASC", "DESC"):
+            with self.subTest(direction=direction):
+                df = fetch_all(self.conn, 5, order_by=[("decoracao", direction)])
+                self.assertEqual(sorted(df["id"]), list(range(1, 53)))
+                values = df["decoracao"].tolist()
+                nulls = [pd.isna(v) for v in values]
+                # NULL por último nas duas direções
+                self.assertEqual(nulls, sorted(nulls))
+                filled = [v for v in values if not pd.isna(v)]
+                self.assertEqual(filled, sorted(filled, reverse=direction == "DESC"))
+
+    def test_two_nullable_keys(self):
+        df = fetch_all(self.conn, 4, order_by=[("decoracao", "ASC"), ("tempo_s", "DESC")])
+        self.assertEqual(sorted(df["id"]), list(range(1, 53)))
+        self.assertEqual(len(df), len(df.drop_duplicates("id")))
+
+    def test_filter_projection_and_page_size(self):
+        sql, params, key_cols = build_select("fichas", COLUMNS, columns=["referencia"],
+                                             where=[("produto", "IN", ["prod1", "prod2"])],
+                                             order_by=[("referencia", "DESC")], limit=3)
+        df, cursor = split_page(pd.read_sql_query(sql, self.conn, params=params), key_cols, 3)
+        self.assertEqual(list(df.columns), ["referencia"])
+        self.assertEqual(df["referencia"].tolist(), ["10050", "10049", "10044"])
+        self.assertIsNotNone(cursor)
+        everything = fetch_all(self.conn, 3, where=[("produto", "IN", ["prod1", "prod2"])])
+        self.assertEqual(len(everything), 18)
+
+    def test_rejects_unknown_names_and_operators(self):
+        with self.assertRaises(ValueError):
+            build_select("fichas", COLUMNS, columns=["nao_existe"])
+        with self.assertRaises(ValueError):
+            build_select("fichas", COLUMNS, where=[("produto", "; DROP", "x")])
+        with self.assertRaises(ValueError):
+            build_select("fichas", COLUMNS, order_by=[("produto", "SIDEWAYS")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+"""sync_db.sync sobre arquivos temporários: python -m unittest discover tests"""
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sync_db  # noqa: E402
+
+
+def write_db(path, referencias, table="fichas"):
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, referencia TEXT)")
+        conn.execute(f"DELETE FROM {table}")
+        conn.executemany(f"INSERT INTO {table} (referencia) VALUES (?)", [(r,) for r in referencias])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def read_refs(path):
+    conn = sqlite3.connect(path)
+    try:
+        return [r[0] for r in conn.execute("SELECT referencia FROM fichas ORDER BY id")]
+    finally:
+        conn.close()
+
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class SyncTest(unittest.TestCase):
+    def setUp(self):
+        self._aviso = sync_db.SWAP_AVISO
+        sync_db.SWAP_AVISO = 0
+        self.tmp = tempfile.TemporaryDirectory()
+        self.origem = os.path.join(self.tmp.name, "rede", "fichas_tecnicas.db")
+        self.destino = os.path.join(self.tmp.name, "local", "fichas_tecnicas.db")
+        os.makedirs(os.path.dirname(self.origem))
+        os.makedirs(os.path.dirname(self.destino))
+        write_db(self.origem, ["17683", "17684"])
+
+    def tearDown(self):
+        sync_db.SWAP_AVISO = self._aviso
+        self.tmp.cleanup()
+
+    def leftovers(self):
+        """Temporários e marcador de troca que não deveriam sobrar na pasta de destino"""
+        return [n for n in os.listdir(os.path.dirname(self.destino))
+                if n.endswith((".tmp", ".swap"))]
+
+    def test_first_sync_copies_and_writes_version(self):
+        self.assertEqual(sync_db.sync(self.origem, self.destino), "atualizado")
+        self.assertEqual(read_refs(self.destino), ["17683", "17684"])
+        self.assertEqual(sync_db.read_version(self.destino)["version"], 1)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_unchanged_source_is_skipped(self):
+        sync_db.sync(self.origem, self.destino)
+        before = read_bytes(self.destino)
+        self.assertEqual(sync_db.sync(self.origem, self.destino), "inalterado")
+        self.assertEqual(read_bytes(self.destino), before)
+        self.assertEqual(sync_db.read_version(self.destino)["version"], 1)
+
+    def test_touched_but_identical_source_keeps_version(self):
+        sync_db.sync(self.origem, self.destino)
+        stat = os.stat(self.origem)
+        os.utime(self.origem, ns=(stat.st_atime_ns, stat.st_mtime_ns + 5 * 10**9))
+        self.assertEqual(sync_db.sync(self.origem, self.destino), "inalterado")
+        info = sync_db.read_version(self.destino)
+        self.assertEqual(info["version"], 1)
+        # O registro passa a ter a data nova: a próxima execução nem calcula o hash
+        self.assertEqual(info["origem_mtime_ns"], os.stat(self.origem).st_mtime_ns)
+
+    def test_edited_source_bumps_version(self):
+        sync_db.sync(self.origem, self.destino)
+        write_db(self.origem, ["17683", "17684", "20001"])
+        self.assertEqual(sync_db.sync(self.origem, self.destino), "atualizado")
+        self.assertEqual(read_refs(self.destino), ["17683", "17684", "20001"])
+        self.assertEqual(sync_db.read_version(self.destino)["version"], 2)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_corrupt_source_leaves_destination_untouched(self):
+        sync_db.sync(self.origem, self.destino)
+        before, info = read_bytes(self.destino), sync_db.read_version(self.destino)
+        with open(self.origem, "wb") as f:
+            f.write(b"isto nao e um banco sqlite" * 400)
+        with self.assertRaises(sqlite3.DatabaseError):
+            sync_db.sync(self.origem, self.destino)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(sync_db.main(["sync_db.py", self.origem, self.destino]), 1)
+        self.assertEqual(read_bytes(self.destino), before)
+        self.assertEqual(sync_db.read_version(self.destino), info)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_source_without_fichas_is_rejected(self):
+        sync_db.sync(self.origem, self.destino)
+        before = read_bytes(self.destino)
+        os.remove(self.origem)
+        write_db(self.origem, ["1"], table="outra")
+        with self.assertRaises(RuntimeError):
+            sync_db.sync(self.origem, self.destino)
+        self.assertEqual(read_bytes(self.destino), before)
+        self.assertEqual(sync_db.read_version(self.destino)["version"], 1)
+        self.assertEqual(self.leftovers(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
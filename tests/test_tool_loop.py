@@ -0,0 +1,112 @@
+"""Laço de ferramentas com modelos de mentira: python -m unittest discover tests"""
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tool_loop import TOOL_MAX_STEPS, LocalToolModel, part_field, run_tool_loop  # noqa: E402
+
+
+class ImagePart:
+    """Imita um Part do google-genai com imagem: atributos, sem suporte a `in`"""
+
+    def __init__(self):
+        self.text = None
+        self.function_response = None
+        self.inline_data = SimpleNamespace(data=b"\x00", mime_type="image/webp")
+
+    def __contains__(self, item):
+        raise TypeError("argument of type 'Part' is not iterable")
+
+
+class FakeTools:
+    def __init__(self, results):
+        self.results = results
+        self.calls = []
+
+    def call(self, name, args):
+        self.calls.append((name, args))
+        return self.results[name]
+
+
+class ScriptedModel:
+    """Devolve as respostas na ordem e guarda o que recebeu em cada rodada"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def generate_content(self, model, contents, config=None):
+        self.requests.append({"contents": list(contents), "config": config})
+        return self.responses.pop(0)
+
+
+def call_response(name, args):
+    content = {"role": "model", "parts": [{"function_call": {"name": name, "args": args}}]}
+    return SimpleNamespace(text=None, candidates=[SimpleNamespace(content=content)],
+                           function_calls=[SimpleNamespace(name=name, args=args)])
+
+
+def text_response(text):
+    return SimpleNamespace(text=text, candidates=[], function_calls=None)
+
+
+class PartFieldTest(unittest.TestCase):
+    def test_dict_and_object_parts(self):
+        self.assertEqual(part_field({"text": "oi"}, "text"), "oi")
+        self.assertIsNone(part_field({"text": "oi"}, "function_response"))
+        self.assertIsNone(part_field(ImagePart(), "text"))
+
+
+class RunToolLoopTest(unittest.TestCase):
+    def test_round_trip(self):
+        tools = FakeTools({"get_reference_parameters": [{"referencia": "17683", "cyan": 0.057}]})
+        models = ScriptedModel([call_response("get_reference_parameters", {"referencia": "17683"}),
+                                text_response("Cyan: 0.057 ml/garrafa")])
+        answer = run_tool_loop(models, "m", ["Consumo da 17683?"], {"tools": []}, tools)
+
+        self.assertEqual(answer, "Cyan: 0.057 ml/garrafa")
+        self.assertEqual(tools.calls, [("get_reference_parameters", {"referencia": "17683"})])
+        last = models.requests[1]["contents"]
+        self.assertEqual([c["role"] for c in last], ["user", "model", "user"])
+        response = last[-1]["parts"][0]["function_response"]
+        self.assertEqual(response["name"], "get_reference_parameters")
+        self.assertEqual(response["response"]["resultado"][0]["cyan"], 0.057)
+
+    def test_last_step_disables_tools(self):
+        tools = FakeTools({"search_fichas": []})
+        models = ScriptedModel([call_response("search_fichas", {"texto": "x"})] * TOOL_MAX_STEPS)
+        self.assertEqual(run_tool_loop(models, "m", ["x"], {}, tools), "")
+        self.assertNotIn("tool_config", models.requests[0]["config"])
+        self.assertEqual(models.requests[-1]["config"]["tool_config"],
+                         {"function_calling_config": {"mode": "NONE"}})
+
+    def test_image_part_is_passed_through(self):
+        image = ImagePart()
+        models = ScriptedModel([text_response("ok")])
+        run_tool_loop(models, "m", ["O que é isto?", image], {}, FakeTools({}))
+        self.assertIs(models.requests[0]["contents"][0]["parts"][1], image)
+
+
+class LocalToolModelTest(unittest.TestCase):
+    def test_round_trip(self):
+        tools = FakeTools({"get_reference_parameters": [{"referencia": "17683", "cyan": 0.057}]})
+        answer = run_tool_loop(LocalToolModel(), "local", ["Consumo de tinta da 17683"], {}, tools)
+
+        self.assertEqual(tools.calls, [("get_reference_parameters", {"referencia": "17683"})])
+        self.assertIn("**get_reference_parameters**", answer)
+        self.assertIn("| referencia | cyan |", answer)
+        self.assertIn("| 17683 | 0.057 |", answer)
+
+    def test_question_with_image(self):
+        tools = FakeTools({"list_errors_by_code": {"linhas": 0}})
+        answer = run_tool_loop(LocalToolModel(), "local", ["Erro E42 nesta peça", ImagePart()], {}, tools)
+
+        self.assertEqual(tools.calls, [("list_errors_by_code", {"codigo": "e42"})])
+        self.assertIn("**list_errors_by_code**", answer)
+
+
+if __name__ == "__main__":
+    unittest.main()
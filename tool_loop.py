@@ -0,0 +1,92 @@
+"""Laço manual de function calling do modo "ferramentas" e o modelo local que o imita.
+
+Fica fora do app.py para poder ser testado sem Streamlit nem rede: não importa o
+app; recebe o cliente (client.models ou LocalToolModel) e as ferramentas (DataTools).
+"""
+import json
+import re
+from types import SimpleNamespace
+
+TOOL_MAX_STEPS = 5
+
+
+def part_field(part, name):
+    """Campo de uma parte do conteúdo, seja dict ou objeto do google-genai (Part com imagem etc.)"""
+    if isinstance(part, dict):
+        return part.get(name)
+    return getattr(part, name, None)
+
+
+def prompt_part(item):
+    """Texto vira parte de texto; a imagem já chega como Part (image_part)"""
+    return {"text": item} if isinstance(item, str) else item
+
+
+class LocalToolModel:
+    """Modelo local que imita client.models para exercitar o laço de ferramentas sem rede.
+
+    Na primeira rodada escolhe as ferramentas pela pergunta (referência, OEE,
+    código de erro ou busca livre); quando recebe os resultados, responde com
+    eles em markdown. `normalize` é a mesma normalização do roteador do app.
+    """
+
+    def __init__(self, normalize=str.lower, reference_pattern=re.compile(r"\b\d{3,6}\b")):
+        self.normalize = normalize
+        self.reference_pattern = reference_pattern
+
+    def generate_content(self, model, contents, config=None):
+        last = contents[-1]
+        parts = part_field(last, "parts") or []
+        responses = [r for r in (part_field(p, "function_response") for p in parts) if r]
+        if responses:
+            return self._answer(responses)
+        text = " ".join(t for t in (part_field(p, "text") for p in parts) if t)
+        calls = self._plan(text)
+        content = {"role": "model", "parts": [{"function_call": {"name": n, "args": a}} for n, a in calls]}
+        return SimpleNamespace(text=None, candidates=[SimpleNamespace(content=content)],
+                               function_calls=[SimpleNamespace(name=n, args=a) for n, a in calls])
+
+    def _plan(self, text):
+        norm = self.normalize(text)
+        codes = self.reference_pattern.findall(norm)
+        if re.search(r"\b(oee|teep|eficiencia)\b", norm):
+            machine = re.search(r"maquina\s+(\w+)", norm)
+            return [("aggregate_oee", {"maquina": machine.group(1) if machine else ""})]
+        error = re.search(r"\b(?:erro|codigo)\s+(?:de\s+)?(\w+)", norm)
+        if error:
+            return [("list_errors_by_code", {"codigo": error.group(1)})]
+        if codes:
+            return [("get_reference_parameters", {"referencia": c}) for c in codes]
+        return [("search_fichas", {"texto": text})]
+
+    def _answer(self, responses):
+        parts = []
+        for r in responses:
+            result = r["response"]["resultado"]
+            parts.append(f"**{r['name']}**")
+            if isinstance(result, list) and result and isinstance(result[0], dict):
+                cols = list(result[0])
+                parts.append("\n".join(["| " + " | ".join(cols) + " |", "|" + "---|" * len(cols)]
+                                       + ["| " + " | ".join(str(row.get(c, "")) for c in cols) + " |"
+                                          for row in result]))
+            else:
+                parts.append(f"```\n{json.dumps(result, ensure_ascii=False, indent=1, default=str)}\n```")
+        return SimpleNamespace(text="\n\n".join(parts), candidates=[], function_calls=None)
+
+
+def run_tool_loop(models, model, full_prompt, config, tools):
+    """Laço manual de function calling: executa o que o modelo pedir até ele responder em texto"""
+    contents = [{"role": "user", "parts": [prompt_part(p) for p in full_prompt]}]
+    for step in range(TOOL_MAX_STEPS):
+        if step == TOOL_MAX_STEPS - 1:
+            # Última rodada: obriga o modelo a responder com o que já tem
+            config = {**config, "tool_config": {"function_calling_config": {"mode": "NONE"}}}
+        resp = models.generate_content(model=model, contents=contents, config=config)
+        calls = resp.function_calls or []
+        if not calls:
+            return resp.text or ""
+        contents.append(resp.candidates[0].content)
+        contents.append({"role": "user", "parts": [
+            {"function_response": {"name": c.name, "response": {"resultado": tools.call(c.name, dict(c.args or {}))}}}
+            for c in calls]})
+    return ""